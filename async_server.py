@@ -0,0 +1,43 @@
+"""
+runs the routes of server.py on a gevent event loop.
+
+gevent's monkey patching turns sockets, sleeps and the locks of the
+connection pool cooperative, and psycogreen puts psycopg2 in its
+asynchronous mode, so a request waiting on postgres yields to the others
+instead of blocking the process. one process can then keep thousands of
+requests in flight, bounded by MAX_CONCURRENCY, sharing a pool of
+POOL_MAX_SIZE connections.
+
+usage: python async_server.py [port]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import sys
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import server
+
+
+# most requests handled at once. more are left waiting in the listen backlog
+MAX_CONCURRENCY = 5000
+
+# greenlets are cheap, connections aren't. requests beyond this many wait
+# on the pool, without holding a postgres backend
+POOL_MAX_SIZE = 50
+
+
+def serve(host='0.0.0.0', port=5000):
+    server.POOL_MAX_SIZE = POOL_MAX_SIZE
+    http = WSGIServer((host, port), server.app, spawn=Pool(MAX_CONCURRENCY), log=None)
+    print "serving %s async on %s:%d" % (server.app.name, host, port)
+    http.serve_forever()
+
+
+if __name__ == "__main__":
+    serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,221 @@
+"""
+load test for the routes of server.py.
+
+every route is driven by a number of concurrent workers, each on its own
+keep-alive connection, optionally at a fixed total request rate. it reports
+p50 / p95 / p99 latency and req/s, per route and overall, and saves them as
+json so runs can be compared.
+
+with a fixed rate, latency is measured from when a request was scheduled,
+not from when it was sent, so a slow server can't hide its queueing delay.
+
+to benchmark against a local postgres loaded with synthetic data:
+    python benchmark_api.py --load --dsn "host=localhost dbname=books" \
+        --books 100000 --reviews 1000000
+and point server.py's DB_DSN at the same database.
+
+usage: python benchmark_api.py --server localhost:5000 --concurrency 50 \
+           --rate 500 --duration 60 --output results.json
+"""
+import argparse
+import httplib
+import json
+import random
+import threading
+import time
+import urllib
+
+import client
+import synthetic_data
+
+
+# path templates of every route, {asin}, {asins} and {q} are filled in per request
+ROUTES = [
+    '/reviews/most_helpful_review',
+    '/reviews/least_helpful_review',
+    '/reviews/most_concise_good_review',
+    '/books/most_expensive_book',
+    '/books/cheapest_book',
+    '/reviews/earliest_review',
+    '/books?order=price&limit=50',
+    '/books?asin={asins}',
+    '/books/{asin}',
+    '/books/{asin}/reviews?order=helpful&limit=20',
+    '/books/{asin}/stats',
+    '/books/{asin}/related?type=also_bought&depth=2',
+    '/search?q={q}&type=books',
+    '/search?q={q}&type=reviews',
+    '/reviews/top?metric=helpful_score&min_votes=10&max_len=200&k=50',
+    '/books/top?metric=price&k=50',
+]
+
+SEARCH_TERMS = ['history', 'love', 'war', 'science', 'mystery novel', 'world']
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = int(round((len(sorted_values) - 1) * p / 100.0))
+    return sorted_values[k]
+
+def summarize(latencies, statuses, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': dict((str(k), v) for k, v in statuses.items()),
+        'req_per_sec': len(latencies) / seconds if seconds else None,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else None,
+    }
+
+def sample_asins(host, port, n=1000):
+    'asins to look up, read from the server itself'
+    try:
+        h = httplib.HTTPConnection(host, port, timeout=30)
+        h.request('GET', '/books?order=asin&limit=%d' % n)
+        books = json.loads(h.getresponse().read())['books']
+        asins = [b['asin'] for b in books if b['asin']]
+    except (httplib.HTTPException, IOError, ValueError, KeyError):
+        asins = []
+    return asins or [synthetic_data.asin_for(i) for i in range(n)]
+
+def fill(template, rng, asins):
+    return template.format(asin=rng.choice(asins),
+                           asins=','.join(rng.sample(asins, min(10, len(asins)))),
+                           q=urllib.quote(rng.choice(SEARCH_TERMS)))
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, host, port, routes, asins, stop_at, interval, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host, self.port = host, port
+        self.routes = routes
+        self.asins = asins
+        self.stop_at = stop_at
+        self.interval = interval
+        self.rng = random.Random(seed)
+        # route -> ([latency ms], {status: count}, errors)
+        self.results = dict((r, ([], {}, [0])) for r in routes)
+
+    def connect(self):
+        return httplib.HTTPConnection(self.host, self.port, timeout=30)
+
+    def run(self):
+        h = self.connect()
+        scheduled = time.time() + self.rng.uniform(0, self.interval or 0)
+        while True:
+            if self.interval:
+                delay = scheduled - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            start = scheduled if self.interval else time.time()
+            if start >= self.stop_at:
+                break
+            route = self.rng.choice(self.routes)
+            latencies, statuses, errors = self.results[route]
+            try:
+                h.request('GET', fill(route, self.rng, self.asins))
+                resp = h.getresponse()
+                resp.read()
+                latencies.append((time.time() - start) * 1000)
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            except (httplib.HTTPException, IOError):
+                errors[0] += 1
+                h.close()
+                h = self.connect()
+            scheduled += self.interval
+
+
+def run(host, port, concurrency, rate, duration, routes):
+    asins = sample_asins(host, port)
+    interval = concurrency / float(rate) if rate else 0
+    stop_at = time.time() + duration
+    workers = [Worker(host, port, routes, asins, stop_at, interval, seed=i)
+               for i in range(concurrency)]
+    started = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - started
+
+    out = {'routes': {}}
+    all_latencies, all_statuses, all_errors = [], {}, 0
+    for route in routes:
+        latencies, statuses, errors = [], {}, 0
+        for w in workers:
+            l, s, e = w.results[route]
+            latencies.extend(l)
+            errors += e[0]
+            for k, v in s.items():
+                statuses[k] = statuses.get(k, 0) + v
+        out['routes'][route] = summarize(latencies, statuses, errors, elapsed)
+        all_latencies.extend(latencies)
+        all_errors += errors
+        for k, v in statuses.items():
+            all_statuses[k] = all_statuses.get(k, 0) + v
+    out['overall'] = summarize(all_latencies, all_statuses, all_errors, elapsed)
+    return out
+
+def load_synthetic(dsn, data_dir, n_books, n_reviews):
+    'generates a synthetic dataset and loads it with data_loader.py'
+    import data_loader
+    data_loader.DB_DSN = dsn
+    books_path, reviews_path = synthetic_data.generate(data_dir, n_books, n_reviews)
+    return data_loader.full_reload(books_path, reviews_path)
+
+def print_report(results):
+    print "%-48s %8s %8s %8s %8s %8s %6s" % ('route', 'requests', 'req/s', 'p50 ms',
+                                            'p95 ms', 'p99 ms', 'errors')
+    rows = sorted(results['routes'].items()) + [('overall', results['overall'])]
+    for route, r in rows:
+        if not r['requests']:
+            print "%-48s %8d %8s %8s %8s %8s %6d" % (route, 0, '-', '-', '-', '-', r['errors'])
+            continue
+        print "%-48s %8d %8.1f %8.1f %8.1f %8.1f %6d" % (
+            route, r['requests'], r['req_per_sec'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            r['errors'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test the routes of server.py')
+    parser.add_argument('--server', default=client.SERVER or 'localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='total requests per second, 0 sends as fast as possible')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--route', action='append',
+                        help='only drive this route template, may be repeated')
+    parser.add_argument('--output', help='file to save the results to as json')
+    parser.add_argument('--load', action='store_true',
+                        help='load a synthetic dataset into --dsn before the run')
+    parser.add_argument('--dsn', default='host=localhost')
+    parser.add_argument('--data-dir', default='synthetic')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--reviews', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.load and not load_synthetic(args.dsn, args.data_dir, args.books, args.reviews):
+        raise SystemExit('loading the synthetic dataset failed')
+
+    host, _, port = args.server.partition(':')
+    routes = args.route or ROUTES
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    results = run(host, int(port or 80), args.concurrency, args.rate, args.duration, routes)
+    results['config'] = {
+        'server': args.server,
+        'concurrency': args.concurrency,
+        'rate': args.rate,
+        'duration': args.duration,
+        'started_at': started_at,
+    }
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "saved results to", args.output
@@ -0,0 +1,89 @@
+"""
+compares the throughput of the sync flask server with the gevent server of
+async_server.py. each one is started on its own port and hit by the same
+number of concurrent keep-alive clients for a fixed time.
+
+usage: python benchmark_async.py [concurrency] [seconds] [path]
+
+the default path pages through /books, which is not cached, so every
+request waits on postgres.
+"""
+import httplib
+import subprocess
+import sys
+import threading
+import time
+
+
+SYNC_PORT = 5101
+ASYNC_PORT = 5102
+
+SERVERS = [
+    ('sync', [sys.executable, '-c',
+              'import server; server.app.run(port=%d, threaded=True)' % SYNC_PORT], SYNC_PORT),
+    ('async', [sys.executable, 'async_server.py', str(ASYNC_PORT)], ASYNC_PORT),
+]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            h = httplib.HTTPConnection('localhost', port, timeout=1)
+            h.request('GET', '/')
+            h.getresponse().read()
+            return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+def client(port, path, stop_at, counts, i):
+    h = httplib.HTTPConnection('localhost', port, timeout=30)
+    done = errors = 0
+    while time.time() < stop_at:
+        try:
+            h.request('GET', path)
+            resp = h.getresponse()
+            resp.read()
+            if resp.status == 200:
+                done += 1
+            else:
+                errors += 1
+        except (httplib.HTTPException, IOError):
+            errors += 1
+            h.close()
+            h = httplib.HTTPConnection('localhost', port, timeout=30)
+    counts[i] = (done, errors)
+
+def run(port, path, concurrency, seconds):
+    counts = [(0, 0)] * concurrency
+    stop_at = time.time() + seconds
+    threads = [threading.Thread(target=client, args=(port, path, stop_at, counts, i))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    done = sum(c[0] for c in counts)
+    errors = sum(c[1] for c in counts)
+    return done / float(seconds), errors
+
+
+if __name__ == '__main__':
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    path = sys.argv[3] if len(sys.argv) > 3 else '/books?order=price&limit=50'
+
+    print "%d concurrent clients for %ds on %s" % (concurrency, seconds, path)
+    print "%-6s %10s %8s" % ('server', 'req/s', 'errors')
+    for name, cmd, port in SERVERS:
+        proc = subprocess.Popen(cmd)
+        try:
+            if not wait_for(port):
+                print "%-6s did not start" % name
+                continue
+            rate, errors = run(port, path, concurrency, seconds)
+            print "%-6s %10.1f %8d" % (name, rate, errors)
+        finally:
+            proc.terminate()
+            proc.wait()
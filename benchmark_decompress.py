@@ -0,0 +1,142 @@
+"""
+compares throughput (lines/sec and decompressed MB/sec) of the ways
+data_loader.py can decompress and parse a compressed input file:
+
+    decompress only      iter_blocks alone, the ceiling for the pipelines
+    serial               decompressing and parsing in turn, in one thread
+    read ahead           decompressing in a read_ahead thread while the
+                         main thread parses, as the serial loader does
+    read ahead + procs   decompressing in a read_ahead thread while a
+                         process pool parses, as iter_parallel does
+
+a gzip and a bz2 copy of a synthetic reviews file are benchmarked unless a
+compressed file is given. first, files of two compressed members are
+checked to read back whole, with the first member ending exactly where a
+read ends.
+
+usage: python benchmark_decompress.py [n_lines] [processes] [file] [books|reviews]
+"""
+import bz2
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
+import data_loader
+from compressed_input import compression, iter_blocks, iter_lines, read_ahead
+from synthetic_data import write_file
+
+
+def decompress_only(path, kind):
+    n = 0
+    for data in iter_blocks(path):
+        n += data.count('\n')
+    return n
+
+def serial(path, kind):
+    transform = data_loader.TRANSFORMS[kind]
+    n = 0
+    for line in iter_lines(iter_blocks(path)):
+        transform(line)
+        n += 1
+    return n
+
+def with_read_ahead(path, kind):
+    transform = data_loader.TRANSFORMS[kind]
+    n = 0
+    for line in iter_lines(read_ahead(iter_blocks(path))):
+        transform(line)
+        n += 1
+    return n
+
+def with_processes(processes):
+    def parallel(path, kind):
+        n = 0
+        for _ in data_loader.iter_parallel(path, kind, processes):
+            n += 1
+        return n
+    return parallel
+
+def check_member_boundaries():
+    """
+    reads back a two member file of each format, its first member ending
+    where a read ends.
+    :return: the formats that read back wrong
+    """
+    first, second = 'first member\n' * 1000, 'second member\n' * 1000
+    failed = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for kind, compress_member in (('gzip', _gzip_member), ('bz2', bz2.compress)):
+            member = compress_member(first)
+            path = os.path.join(tmp_dir, 'members.' + kind)
+            with open(path, 'wb') as f:
+                f.write(member + compress_member(second))
+            if ''.join(iter_blocks(path, read_size=len(member))) != first + second:
+                failed.append(kind)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return failed
+
+def _gzip_member(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+def decompressed_size(path):
+    return sum(len(data) for data in iter_blocks(path))
+
+def compress(src, dst, open_compressed):
+    with open(src, 'rb') as f:
+        out = open_compressed(dst, 'wb')
+        try:
+            shutil.copyfileobj(f, out, 1024 * 1024)
+        finally:
+            out.close()
+    return dst
+
+
+if __name__ == '__main__':
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    failed = check_member_boundaries()
+    if failed:
+        sys.exit("members ending on a read boundary read back wrong: " + ", ".join(failed))
+
+    tmp_dir = None
+    if len(sys.argv) > 3:
+        paths = [sys.argv[3]]
+        kind = sys.argv[4] if len(sys.argv) > 4 else 'reviews'
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        plain = os.path.join(tmp_dir, 'reviews_Books.json')
+        print "generating %d synthetic review lines" % n_lines
+        write_file(plain, 'reviews', n_lines, max(1, n_lines // 10), max(1, n_lines // 5),
+                   3.0, 0)
+        paths = [compress(plain, plain + '.gz', gzip.open),
+                 compress(plain, plain + '.bz2', bz2.BZ2File)]
+        kind = 'reviews'
+
+    pipelines = [('decompress only', decompress_only), ('serial', serial),
+                 ('read ahead', with_read_ahead),
+                 ('read ahead + %d procs' % processes, with_processes(processes))]
+    try:
+        for path in paths:
+            mb = decompressed_size(path) / float(1024 * 1024)
+            print "%s: %s, %.1f MB decompressed" % (os.path.basename(path), compression(path), mb)
+            print "%-22s %12s %10s" % ('pipeline', 'lines/sec', 'MB/sec')
+            for name, pipeline in pipelines:
+                started = time.time()
+                n = pipeline(path, kind)
+                elapsed = time.time() - started
+                print "%-22s %12.0f %10.1f" % (name, n / elapsed, mb / elapsed)
+            print
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
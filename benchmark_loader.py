@@ -0,0 +1,99 @@
+"""
+compares load throughput (rows/sec) of the bulk loading methods in
+data_loader.py: COPY FROM STDIN, multi-row VALUES and executemany.
+
+rows are synthetic, in the same shape the transforms produce, and are loaded
+into temp tables so nothing in the real schema is touched.
+
+usage: python benchmark_loader.py [n_rows] [batch_size]
+"""
+import json
+import random
+import sys
+import time
+
+import psycopg2
+
+import data_loader
+from data_loader import BOOKS_COLUMNS, REVIEWS_COLUMNS, LOADERS
+
+
+def fake_asin(rng):
+    return ''.join(rng.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(10))
+
+def fake_books_rows(n, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        title = u'Book title %d with a "quote"' % i
+        description = u'line one\tcol\nline two \\ backslash ' * rng.randint(1, 5)
+        related = [[fake_asin(rng) for _ in range(rng.randint(0, 20))] for _ in range(4)]
+        rows.append((fake_asin(rng), title, len(title), description, len(description), u'Books',
+                     round(rng.uniform(1, 100), 2), u'http://example.com/%d.jpg' % i,
+                     related[0], related[1], related[2], related[3], u'Books', rng.randint(1, 10 ** 6),
+                     len(related[0]), len(related[1]), len(related[2]), len(related[3])))
+    return rows
+
+def fake_reviews_rows(n, seed=0):
+    'rows made by transform_review_line from lines shaped like the dump, float ratings and all'
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        total = rng.randint(0, 50)
+        unix_time = rng.randint(850000000, 1400000000)
+        review = {
+            'asin': fake_asin(rng),
+            'helpful': [rng.randint(0, total), total],
+            'overall': float(rng.randint(1, 5)),
+            'reviewText': u'review text %d ' % i * rng.randint(1, 40),
+            'reviewTime': time.strftime('%m %d, %Y', time.gmtime(unix_time)),
+            'reviewerID': fake_asin(rng),
+            'reviewerName': u'reviewer %d' % rng.randint(0, n),
+            'summary': u'summary %d' % i,
+            'unixReviewTime': unix_time,
+        }
+        rows.append(data_loader.transform_review_line(json.dumps(review)))
+    return rows
+
+def bench(cur, table, columns, rows, method, batch_size):
+    cur.execute("TRUNCATE %s;" % table)
+    started = time.time()
+    n = LOADERS[method](cur, table, columns, iter(rows), batch_size)
+    elapsed = time.time() - started
+    return n / elapsed if elapsed else float('inf')
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else data_loader.BATCH_SIZE
+
+    print "generating %d synthetic rows per table" % n_rows
+    data = {
+        'bench_books': (BOOKS_COLUMNS, fake_books_rows(n_rows)),
+        'bench_reviews': (REVIEWS_COLUMNS, fake_reviews_rows(n_rows)),
+    }
+
+    conn = psycopg2.connect(dsn=data_loader.DB_DSN)
+    conn.set_client_encoding('UTF8')
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE bench_books (asin text, title text, len_title int, \
+                   description text, len_description int, category text, price float, \
+                   imurl text, also_viewed text array, also_bought text array, \
+                   bought_together text array, buy_after_viewing text array, \
+                   sales_rank_category text, sales_rank_code bigint, len_also_viewed int, \
+                   len_also_bought int, len_bought_together int, len_buy_after_viewing int);")
+    cur.execute("CREATE TEMP TABLE bench_reviews (asin text, helpful_count int, \
+                   total_helpful_votes int, helpful_score float, overall int, review text, \
+                   len_review_character_count int, review_time date, reviewer_id text, \
+                   reviewer_name text, summary text, unix_review_time bigint);")
+
+    print "%-14s %-12s %12s" % ('table', 'method', 'rows/sec')
+    for table in sorted(data):
+        columns, rows = data[table]
+        for method in ('executemany', 'values', 'copy'):
+            rate = bench(cur, table, columns, rows, method, batch_size)
+            conn.commit()
+            print "%-14s %-12s %12.0f" % (table, method, rate)
+
+    cur.close()
+    conn.close()
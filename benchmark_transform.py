@@ -0,0 +1,68 @@
+"""
+compares parse throughput (lines/sec) of the two review line transforms in
+data_loader.py: transform_review_line, with its get_* helpers and a
+strptime per review, and transform_review_line_fast, which the loader uses.
+both are run over the same lines held in memory, so file reads aren't
+timed, and their output is checked to be identical.
+
+lines are read from a reviews file if one is given, else synthetic ones are
+made with synthetic_data.py.
+
+usage: python benchmark_transform.py [n_lines] [reviews file]
+"""
+import json
+import random
+import sys
+import time
+from itertools import islice
+
+import data_loader
+from data_loader import transform_review_line, transform_review_line_fast
+from synthetic_data import fake_review
+
+
+# each transform is timed this many times over all the lines, the best run counts
+REPEATS = 3
+
+def synthetic_lines(n, seed=0):
+    rng = random.Random(seed)
+    n_books = max(1, n // 20)
+    return [json.dumps(fake_review(rng, n_books, max(1, n // 5), 3.0)) + '\n'
+            for _ in range(n)]
+
+def file_lines(path, n):
+    with open(path) as f:
+        return list(islice(f, n))
+
+def bench(transform, lines):
+    best = None
+    for _ in range(REPEATS):
+        # a cold date cache each run, as in a fresh loader process
+        data_loader._review_dates.clear()
+        started = time.time()
+        for line in lines:
+            transform(line)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best if best else float('inf')
+
+
+if __name__ == '__main__':
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    if len(sys.argv) > 2:
+        print "reading %d lines of %s" % (n_lines, sys.argv[2])
+        lines = file_lines(sys.argv[2], n_lines)
+    else:
+        print "generating %d synthetic review lines" % n_lines
+        lines = synthetic_lines(n_lines)
+
+    for line in lines:
+        if transform_review_line(line) != transform_review_line_fast(line):
+            sys.exit("transforms disagree on line: %s" % line)
+
+    print "%-28s %12s" % ('transform', 'lines/sec')
+    rates = {}
+    for transform in (transform_review_line, transform_review_line_fast):
+        rates[transform] = bench(transform, lines)
+        print "%-28s %12.0f" % (transform.__name__, rates[transform])
+    print "speedup %.2fx" % (rates[transform_review_line_fast] / rates[transform_review_line])
@@ -1,56 +1,254 @@
+import gzip
 import httplib
+import json
+import random
+import threading
+import time
+import urllib
+from collections import OrderedDict
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from Queue import Empty, Queue
 
 # use this server for prod, once it's on ec2
 SERVER = ''
 
+# most keep-alive connections a client holds open, and most requests in flight
+MAX_CONNECTIONS = 10
+
+# seconds before a request gives up
+TIMEOUT = 30
+
+# a failed request is tried again this many times, waiting
+# RETRY_BACKOFF * 2 ** attempt seconds (plus jitter) in between
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.1
+
+# statuses worth retrying, the server is restarting or overloaded
+RETRY_STATUSES = (502, 503, 504)
+
+# responses kept for If-None-Match revalidation, 0 turns the client cache off
+ETAG_CACHE_SIZE = 256
+
+SUPERLATIVE_PATHS = {
+    'most_helpful_review': '/reviews/most_helpful_review',
+    'least_helpful_review': '/reviews/least_helpful_review',
+    'most_concise_good_review': '/reviews/most_concise_good_review',
+    'most_expensive_book': '/books/most_expensive_book',
+    'cheapest_book': '/books/cheapest_book',
+    'earliest_review': '/reviews/earliest_review',
+}
+
+
+class ApiError(Exception):
+    'the server answered with a status other than 200 or 304'
+
+    def __init__(self, status, body):
+        Exception.__init__(self, 'HTTP %d: %s' % (status, body[:200]))
+        self.status = status
+        self.body = body
+
+
+class Client(object):
+    """
+    a thread safe client for server.py.
+
+    connections are kept alive and reused across requests, up to
+    max_connections at a time. failed requests are retried with exponential
+    backoff, and 200 responses with an ETag are kept so a later request for
+    the same path only costs a 304.
+    """
+
+    def __init__(self, server=None, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, etag_cache_size=ETAG_CACHE_SIZE):
+        self.server = server or SERVER
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.etag_cache_size = etag_cache_size
+
+        self._idle = Queue()
+        # a token per connection slot, so at most max_connections are open
+        self._slots = Queue()
+        for _ in xrange(max_connections):
+            self._slots.put(None)
+        self._lock = threading.Lock()
+        self._etags = OrderedDict()    # path -> (etag, body)
+        self._workers = None
+        self.stats = {'requests': 0, 'retries': 0, 'not_modified': 0, 'connections': 0}
+
+    def _checkout(self):
+        self._slots.get()
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                self.stats['connections'] += 1
+            return httplib.HTTPConnection(self.server, timeout=self.timeout)
+
+    def _checkin(self, conn, keep=True):
+        if keep:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.put(None)
+
+    def _cached(self, path):
+        with self._lock:
+            return self._etags.get(path)
+
+    def _remember(self, path, etag, body):
+        if not self.etag_cache_size:
+            return
+        with self._lock:
+            self._etags.pop(path, None)
+            self._etags[path] = (etag, body)
+            while len(self._etags) > self.etag_cache_size:
+                self._etags.popitem(last=False)
+
+    def _send(self, method, path, body=None):
+        """
+        makes one request on a pooled connection.
+        :return: (status, body str, ETag or None)
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        cached = self._cached(path) if method == 'GET' else None
+        if cached is not None:
+            headers['If-None-Match'] = '"%s"' % cached[0]
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+
+        conn = self._checkout()
+        keep = False
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            data = resp.read()
+            keep = not resp.will_close
+        finally:
+            self._checkin(conn, keep)
+
+        if resp.status == 304 and cached is not None:
+            with self._lock:
+                self.stats['not_modified'] += 1
+            return 200, cached[1], cached[0]
+        if resp.getheader('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        etag = resp.getheader('ETag')
+        if etag:
+            etag = etag.strip('"')
+        return resp.status, data, etag
+
+    def fetch(self, method, path, body=None):
+        """
+        sends a request, retrying connection errors and RETRY_STATUSES. only
+        GETs are retried, a POST may not be safe to send twice.
+        :return: (status, response body as a str), whatever the status
+        """
+        retries = self.max_retries if method == 'GET' else 0
+        attempt = 0
+        while True:
+            with self._lock:
+                self.stats['requests'] += 1
+            try:
+                status, data, etag = self._send(method, path, body)
+                if status not in RETRY_STATUSES or attempt >= retries:
+                    break
+            except (httplib.HTTPException, IOError):
+                if attempt >= retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+            with self._lock:
+                self.stats['retries'] += 1
+
+        if status == 200 and method == 'GET' and etag:
+            self._remember(path, etag, data)
+        return status, data
+
+    def request(self, method, path, body=None):
+        """
+        like fetch, but raises ApiError unless the status is 200.
+        :return: the response body as a str
+        """
+        status, data = self.fetch(method, path, body)
+        if status != 200:
+            raise ApiError(status, data)
+        return data
+
+    def get(self, path, **params):
+        'GETs path with params as the query string and decodes the json'
+        if params:
+            path += '?' + urllib.urlencode(params, doseq=True)
+        return json.loads(self.request('GET', path))
+
+    def post(self, path, obj):
+        return json.loads(self.request('POST', path, json.dumps(obj)))
+
+    def get_many(self, paths):
+        """
+        GETs every path concurrently, on up to max_connections connections.
+        :return: the decoded responses, in the order of paths
+        """
+        with self._lock:
+            if self._workers is None:
+                self._workers = ThreadPool(self.max_connections)
+        return self._workers.map(self.get, paths)
+
+    def superlatives(self):
+        'every superlative endpoint, fetched in parallel, keyed by name'
+        names = sorted(SUPERLATIVE_PATHS)
+        return dict(zip(names, self.get_many([SUPERLATIVE_PATHS[n] for n in names])))
+
+    def book(self, asin):
+        return self.get('/books/%s' % urllib.quote(asin))
+
+    def books(self, asins):
+        'many books in one request'
+        return self.post('/books', {'asins': list(asins)})['books']
+
+    def close(self):
+        if self._workers is not None:
+            self._workers.close()
+            self._workers = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+
+_default = None
+
+def default_client():
+    """
+    a client shared by the module level functions below. like they always
+    have, they return the response body whatever its status
+    """
+    global _default
+    if _default is None:
+        _default = Client(SERVER)
+    return _default
+
 
 def get_most_helpful_review():
-    out = dict()
-    h = httplib.HTTPConnection(SERVER)
-    h.request('GET', 'http://'+SERVER+'/reviews/most_helpful_review')
-    resp = h.getresponse()
-    out = resp.read()
-    return out
+    return default_client().fetch('GET', SUPERLATIVE_PATHS['most_helpful_review'])[1]
 
 def get_least_helpful_review():
-    out = dict()
-    h = httplib.HTTPConnection(SERVER)
-    h.request('GET', 'http://'+SERVER+'/reviews/least_helpful_review')
-    resp = h.getresponse()
-    out = resp.read()
-    return out
+    return default_client().fetch('GET', SUPERLATIVE_PATHS['least_helpful_review'])[1]
 
 def get_most_concise_helpful_review():
-    out = dict()
-    h = httplib.HTTPConnection(SERVER)
-    h.request('GET', 'http://'+SERVER+'/reviews/most_concise_good_review')
-    resp = h.getresponse()
-    out = resp.read()
-    return out
+    return default_client().fetch('GET', SUPERLATIVE_PATHS['most_concise_good_review'])[1]
 
 def get_most_expensive_book():
-    out = dict()
-    h = httplib.HTTPConnection(SERVER)
-    h.request('GET', 'http://'+SERVER+'/books/most_expensive_book')
-    resp = h.getresponse()
-    out = resp.read()
-    return out
+    return default_client().fetch('GET', SUPERLATIVE_PATHS['most_expensive_book'])[1]
 
 def get_cheapest_book():
-    out = dict()
-    h = httplib.HTTPConnection(SERVER)
-    h.request('GET', 'http://'+SERVER+'/books/cheapest_book')
-    resp = h.getresponse()
-    out = resp.read()
-    return out
+    return default_client().fetch('GET', SUPERLATIVE_PATHS['cheapest_book'])[1]
 
 def get_earliest_review():
-    out = dict()
-    h = httplib.HTTPConnection(SERVER)
-    h.request('GET', 'http://'+SERVER+'/reviews/earliest_review')
-    resp = h.getresponse()
-    out = resp.read()
-    return out
+    return default_client().fetch('GET', SUPERLATIVE_PATHS['earliest_review'])[1]
 
 if __name__ == '__main__':
     print "*********************************************************"
@@ -70,7 +268,6 @@ if __name__ == '__main__':
     print
     print "**********       get most expensive book        **********"
     print get_most_expensive_book()
-    print 
+    print
     print "***********          get cheapest book          **********"
     print get_cheapest_book()
-    
\ No newline at end of file
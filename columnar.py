@@ -0,0 +1,199 @@
+"""
+a compact columnar copy of the books and reviews data for analytics.
+
+every column is its own .npy file that can be memory mapped: numbers in
+typed arrays, dates as datetime64[D], asins as int32 codes into one
+dictionary shared by both tables, and text as a utf-8 .bin file plus an
+.offsets.npy array of where each value starts. columns are written a batch
+at a time, so memory stays bounded by the batch size, not the file size.
+
+layout of a columnar directory:
+    asin_dictionary.npy    the distinct asins, indexed by code
+    book_by_code.npy       the books row of each asin code, -1 if none
+    books/<column>.npy     reviews/<column>.npy
+    books/<column>.bin     reviews/<column>.bin, with <column>.offsets.npy
+    meta.json              row counts and column types
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+from numpy.lib import format as npy_format
+
+
+# (column, type) of each table. types are numpy dtypes, 'asin' for
+# dictionary encoded asins, 'date' for YYYY-MM-DD strings and 'text'
+BOOK_COLUMNS = [
+    ('asin', 'asin'),
+    ('title', 'text'),
+    ('len_title', 'i4'),
+    ('len_description', 'i4'),
+    ('category', 'text'),
+    ('price', 'f8'),
+    ('sales_rank_code', 'i8'),
+    ('len_also_viewed', 'i4'),
+    ('len_also_bought', 'i4'),
+    ('len_bought_together', 'i4'),
+    ('len_buy_after_viewing', 'i4'),
+]
+
+REVIEW_COLUMNS = [
+    ('asin', 'asin'),
+    ('helpful_count', 'i4'),
+    ('total_helpful_votes', 'i4'),
+    ('helpful_score', 'f8'),
+    ('overall', 'i1'),
+    ('len_review_character_count', 'i4'),
+    ('review_time', 'date'),
+    ('unix_review_time', 'i8'),
+    ('reviewer_id', 'text'),
+    ('reviewer_name', 'text'),
+    ('summary', 'text'),
+    ('review', 'text'),
+]
+
+TABLE_COLUMNS = {'books': BOOK_COLUMNS, 'reviews': REVIEW_COLUMNS}
+
+
+def _utf8(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _finish_npy(raw_path, npy_path, dtype, n):
+    'prepends an .npy header to a file of n raw values'
+    with open(npy_path, 'wb') as out:
+        header = {'descr': npy_format.dtype_to_descr(np.dtype(dtype)),
+                  'fortran_order': False, 'shape': (n,)}
+        npy_format.write_array_header_1_0(out, header)
+        with open(raw_path, 'rb') as f:
+            shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+    os.remove(raw_path)
+
+
+class AsinDictionary(object):
+    'assigns each distinct asin an int32 code in order of first appearance'
+
+    def __init__(self):
+        self.codes = {}
+        self.asins = []
+
+    def encode(self, values):
+        codes = self.codes
+        out = np.empty(len(values), dtype='i4')
+        for i, asin in enumerate(values):
+            asin = _utf8(asin)
+            code = codes.get(asin)
+            if code is None:
+                code = codes[asin] = len(self.asins)
+                self.asins.append(asin)
+            out[i] = code
+        return out
+
+    def save(self, path):
+        width = max([len(a) for a in self.asins] or [1])
+        np.save(path, np.array(self.asins, dtype='S%d' % width))
+
+
+class TableWriter(object):
+    """
+    writes the columns of one table to out_dir/<table>/.
+    :param source_columns: the column names of the row tuples passed to write
+    """
+
+    def __init__(self, out_dir, table, source_columns, dictionary):
+        self.dir = os.path.join(out_dir, table)
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        self.columns = TABLE_COLUMNS[table]
+        self.index = [source_columns.index(name) for name, _ in self.columns]
+        self.dictionary = dictionary
+        self.rows = 0
+        self._files = {}
+        self._text_offset = {}
+        for name, kind in self.columns:
+            if kind == 'text':
+                self._files[name] = open(os.path.join(self.dir, name + '.bin'), 'wb')
+                self._files[name + '.offsets'] = open(self._raw(name + '.offsets'), 'wb')
+                self._text_offset[name] = 0
+            else:
+                self._files[name] = open(self._raw(name), 'wb')
+
+    def _raw(self, name):
+        return os.path.join(self.dir, name + '.raw')
+
+    def write(self, rows):
+        'appends a batch of row tuples'
+        if not rows:
+            return
+        values = zip(*rows)
+        for (name, kind), i in zip(self.columns, self.index):
+            col = values[i]
+            if kind == 'asin':
+                self.dictionary.encode(col).tofile(self._files[name])
+            elif kind == 'date':
+                np.array([v[:10] for v in col], dtype='M8[D]').tofile(self._files[name])
+            elif kind == 'text':
+                data = [_utf8(v) for v in col]
+                ends = np.cumsum([len(v) for v in data], dtype='i8')
+                starts = np.empty(len(data), dtype='i8')
+                starts[0] = self._text_offset[name]
+                starts[1:] = self._text_offset[name] + ends[:-1]
+                self._text_offset[name] += int(ends[-1])
+                starts.tofile(self._files[name + '.offsets'])
+                self._files[name].write(''.join(data))
+            else:
+                np.array(col, dtype=kind).tofile(self._files[name])
+        self.rows += len(rows)
+
+    def close(self):
+        'turns the raw column files into .npy files'
+        for f in self._files.values():
+            f.close()
+        for name, kind in self.columns:
+            if kind == 'text':
+                # one more offset, so value i is data[offsets[i]:offsets[i + 1]]
+                with open(self._raw(name + '.offsets'), 'ab') as f:
+                    np.array([self._text_offset[name]], dtype='i8').tofile(f)
+                _finish_npy(self._raw(name + '.offsets'),
+                            os.path.join(self.dir, name + '.offsets.npy'), 'i8', self.rows + 1)
+            else:
+                dtype = {'asin': 'i4', 'date': 'M8[D]'}.get(kind, kind)
+                _finish_npy(self._raw(name), os.path.join(self.dir, name + '.npy'), dtype,
+                            self.rows)
+
+
+def write_columnar(out_dir, books_batches, books_columns, reviews_batches, reviews_columns):
+    """
+    writes both tables to out_dir.
+    :param books_batches: iterable of lists of book tuples in books_columns order
+    :param reviews_batches: the same for reviews
+    :return: {table: rows written}
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    dictionary = AsinDictionary()
+    counts = {}
+    for table, row_batches, columns in (('books', books_batches, books_columns),
+                                        ('reviews', reviews_batches, reviews_columns)):
+        writer = TableWriter(out_dir, table, columns, dictionary)
+        try:
+            for batch in row_batches:
+                writer.write(batch)
+        finally:
+            writer.close()
+        counts[table] = writer.rows
+
+    dictionary.save(os.path.join(out_dir, 'asin_dictionary.npy'))
+    book_codes = np.load(os.path.join(out_dir, 'books', 'asin.npy'), mmap_mode='r')
+    book_by_code = np.full(len(dictionary.asins), -1, dtype='i4')
+    book_by_code[book_codes] = np.arange(len(book_codes), dtype='i4')
+    np.save(os.path.join(out_dir, 'book_by_code.npy'), book_by_code)
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'rows': counts, 'asins': len(dictionary.asins),
+                   'columns': dict((t, c) for t, c in TABLE_COLUMNS.items())}, f, indent=2)
+    return counts
@@ -0,0 +1,160 @@
+"""
+answers the superlative questions of queries.py from a columnar export
+(see columnar.py) with array reductions over memory-mapped columns, no db
+needed. each answer has the same keys as the row its sql returns.
+
+usage: python columnar_queries.py [columnar dir]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+
+# reviews dated on or before this were loaded without a date
+NO_REVIEW_TIME = np.datetime64('1900-01-01')
+
+
+class ColumnarStore(object):
+    'lazily memory maps the columns of a columnar directory'
+
+    def __init__(self, path):
+        self.path = path
+        self._arrays = {}
+
+    def _load(self, name):
+        a = self._arrays.get(name)
+        if a is None:
+            a = self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'),
+                                             mmap_mode='r')
+        return a
+
+    def column(self, table, name):
+        return self._load('%s/%s' % (table, name))
+
+    def text(self, table, name, row):
+        'the text value of column name in row, as unicode'
+        offsets = self._load('%s/%s.offsets' % (table, name))
+        start, end = offsets[row], offsets[row + 1]
+        if start == end:
+            return u''
+        data = self._arrays.get((table, name))
+        if data is None:
+            data = self._arrays[(table, name)] = np.memmap(
+                os.path.join(self.path, table, name + '.bin'), dtype='u1', mode='r')
+        return data[start:end].tostring().decode('utf-8')
+
+    def book_by_code(self):
+        'the books row of each asin code, -1 for asins without a book'
+        return self._load('book_by_code')
+
+    def book_row(self, review_row):
+        'the books row of the book a review is about, -1 if it is not in books'
+        code = self.column('reviews', 'asin')[review_row]
+        return int(self.book_by_code()[code])
+
+    def book_title(self, book_row):
+        return self.text('books', 'title', book_row) if book_row >= 0 else None
+
+
+def best_row(keys, mask=None):
+    """
+    the row ORDER BY keys LIMIT 1 would return, or None if no row qualifies.
+    :param keys: (array, 'desc' or 'asc') pairs, the first one sorts first
+    :param mask: optional boolean array of the rows to consider
+    each key is reduced over the rows still tied on the keys before it, so
+    only the first key is scanned in full.
+    """
+    rows = None if mask is None else np.flatnonzero(mask)
+    for values, direction in keys:
+        if rows is not None:
+            if not len(rows):
+                return None
+            values = values[rows]
+        elif not len(values):
+            return None
+        target = values.max() if direction == 'desc' else values.min()
+        tied = np.flatnonzero(values == target)
+        rows = tied if rows is None else rows[tied]
+        if len(rows) == 1:
+            break
+    return int(rows[0])
+
+def _review_answer(store, row, field):
+    if row is None:
+        return {}
+    return {
+        'title': store.book_title(store.book_row(row)),
+        'reviewer_name': store.text('reviews', 'reviewer_name', row),
+        field: store.text('reviews', 'review', row),
+    }
+
+def _book_answer(store, row):
+    if row is None:
+        return {}
+    return {'title': store.book_title(row),
+            'price': float(store.column('books', 'price')[row])}
+
+def most_helpful_review(store):
+    row = best_row([(store.column('reviews', 'helpful_score'), 'desc'),
+                    (store.column('reviews', 'total_helpful_votes'), 'desc')])
+    return _review_answer(store, row, 'most_helpful_review')
+
+def least_helpful_review(store):
+    row = best_row([(store.column('reviews', 'total_helpful_votes'), 'desc')],
+                   store.column('reviews', 'helpful_score') == 0)
+    return _review_answer(store, row, 'least_helpful_review')
+
+def most_concise_good_review(store):
+    row = best_row([(store.column('reviews', 'helpful_score'), 'desc'),
+                    (store.column('reviews', 'total_helpful_votes'), 'desc')],
+                   store.column('reviews', 'len_review_character_count') < 40)
+    return _review_answer(store, row, 'most_concise_good_review')
+
+def most_expensive_book(store):
+    price = store.column('books', 'price')
+    return _book_answer(store, best_row([(price, 'desc')]))
+
+def cheapest_book(store):
+    price = store.column('books', 'price')
+    return _book_answer(store, best_row([(price, 'asc')], price > -1))
+
+def earliest_review(store):
+    review_time = store.column('reviews', 'review_time')
+    # an inner join with books, like the left join of the sql after its where
+    has_book = store.book_by_code()[store.column('reviews', 'asin')] >= 0
+    row = best_row([(review_time, 'asc')], (review_time > NO_REVIEW_TIME) & has_book)
+    if row is None:
+        return {}
+    return {
+        'title': store.book_title(store.book_row(row)),
+        'review_time': str(review_time[row]),
+        'review': store.text('reviews', 'review', row),
+    }
+
+# superlative name, as in queries.SUPERLATIVE_QUERIES -> function of a
+# ColumnarStore returning its answer
+COLUMNAR_QUERIES = {
+    'most_helpful_review': most_helpful_review,
+    'least_helpful_review': least_helpful_review,
+    'most_concise_good_review': most_concise_good_review,
+    'most_expensive_book': most_expensive_book,
+    'cheapest_book': cheapest_book,
+    'earliest_review': earliest_review,
+}
+
+def superlatives(path):
+    'every superlative answer of the columnar export at path'
+    store = ColumnarStore(path)
+    return dict((name, f(store)) for name, f in COLUMNAR_QUERIES.items())
+
+
+if __name__ == '__main__':
+    store = ColumnarStore(sys.argv[1] if len(sys.argv) > 1 else 'columnar')
+    for name in sorted(COLUMNAR_QUERIES):
+        started = time.time()
+        answer = COLUMNAR_QUERIES[name](store)
+        print "%-26s %8.1f ms  %r" % (name, (time.time() - started) * 1000,
+                                     dict((k, v[:60] if isinstance(v, basestring) else v)
+                                          for k, v in answer.items()))
@@ -0,0 +1,173 @@
+"""
+reads the input dumps the way they ship: gzip, bz2 or zstd compressed, or
+plain. the format is told from the first bytes of a file, not its name.
+files are decompressed as a stream, a block at a time, so nothing is
+written to disk and memory stays bounded by the block size.
+
+files made of several compressed members, as pigz and pbzip2 write them,
+are read through to the last member. a compressed stream can't be seeked
+into, so byte ranges and resume offsets only apply to plain files, see
+file_chunks and load_incremental in data_loader.py.
+"""
+import bz2
+import Queue
+import sys
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# leading bytes of each compressed format
+MAGIC = (('gzip', '\x1f\x8b'), ('bz2', 'BZh'), ('zstd', '\x28\xb5\x2f\xfd'))
+
+# compressed bytes read from the file at a time
+READ_SIZE = 1024 * 1024
+
+# decompressed blocks a read_ahead thread may get ahead of its reader. 0
+# decompresses in the reader's own thread
+READ_AHEAD = 8
+
+
+def compression(path):
+    'gzip, bz2 or zstd if path is compressed that way, else None'
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for name, magic in MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+def _decompressor(kind):
+    if kind == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+def iter_blocks(path, read_size=READ_SIZE):
+    'yields the decompressed contents of path a block at a time'
+    kind = compression(path)
+    if kind == 'zstd' and zstandard is None:
+        raise ValueError('%s is zstd compressed, reading it needs the zstandard package' % path)
+    with open(path, 'rb') as f:
+        if kind is None:
+            for data in iter(lambda: f.read(read_size), ''):
+                yield data
+        elif kind == 'zstd':
+            for data in zstandard.ZstdDecompressor().read_to_iter(f, read_size=read_size):
+                yield data
+        else:
+            d = _decompressor(kind)
+            for data in iter(lambda: f.read(read_size), ''):
+                while data:
+                    try:
+                        out = d.decompress(data)
+                    except EOFError:
+                        # a bz2 member ended exactly at the end of the last read
+                        d = _decompressor(kind)
+                        continue
+                    if out:
+                        yield out
+                    # input past the end of a member starts the next one
+                    data = d.unused_data
+                    if data:
+                        d = _decompressor(kind)
+
+def iter_lines(blocks):
+    'splits blocks of text into lines, without their newlines'
+    rest = ''
+    for data in blocks:
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+def line_chunks(blocks, chunk_size):
+    """
+    regroups blocks of text into chunks of about chunk_size bytes that each
+    end just after a newline (or at the end), so no line is split across
+    chunks.
+    """
+    pending = []
+    size = 0
+    for data in blocks:
+        pending.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            text = ''.join(pending)
+            cut = text.rfind('\n') + 1
+            if cut:
+                yield text[:cut]
+                pending = [text[cut:]]
+                size = len(text) - cut
+            else:
+                pending = [text]
+    text = ''.join(pending)
+    if text:
+        yield text
+
+def read_ahead(items, depth=READ_AHEAD):
+    """
+    iterates items in a background thread, at most depth items ahead of the
+    caller, so decompressing the next blocks overlaps with whatever the
+    caller does with this one. zlib, bz2 and zstd release the gil while
+    they work. errors in the thread are raised in the caller.
+    """
+    if not depth:
+        for item in items:
+            yield item
+        return
+
+    queue = Queue.Queue(depth)
+    stopped = threading.Event()
+
+    def put(entry):
+        # gives up once the caller has stopped reading
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((None, None))
+        except Exception:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if item is None:
+                break
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+def read_lines(path):
+    """
+    the lines of path, decompressed in a read_ahead thread if it is
+    compressed. plain files are read line by line as usual
+    """
+    if compression(path) is None:
+        with open(path) as f:
+            for line in f:
+                yield line
+    else:
+        for line in iter_lines(read_ahead(iter_blocks(path))):
+            yield line
@@ -1,15 +1,135 @@
+import ast
+from collections import deque
 from datetime import datetime
+import hashlib
 import json
-import psycopg2, psycopg2.extras
+import multiprocessing
+import os
+import Queue
+import sqlite3
+import sys
+import traceback
+import psycopg2, psycopg2.extensions, psycopg2.extras
+
+from compressed_input import compression, iter_blocks, line_chunks, read_ahead, read_lines
+from queries import SUPERLATIVE_QUERIES
+from related_graph import RelatedGraph, iter_related_rows
+from serialization import dumps
+from snapshot import SNAPSHOT_COLUMNS, write_snapshot
+
+try:
+    import columnar
+except ImportError:
+    columnar = None
 
 
 # DSN location of the AWS - RDS instance
 DB_DSN = ""
 
-# location of the input data file
+# schema the loader creates and fills its tables in. a full reload builds
+# everything in SHADOW_SCHEMA, then swaps the tables into LIVE_SCHEMA at once
+LIVE_SCHEMA = 'public'
+SHADOW_SCHEMA = 'shadow'
+RETIRED_SCHEMA = 'retired'
+LOAD_SCHEMA = LIVE_SCHEMA
+
+# tables rebuilt by a full reload and swapped in together
+SWAPPED_TABLES = ('books', 'reviews', 'book_stats', 'superlatives')
+
+# how long the swap may wait for the server's queries to release the tables,
+# and how many times it is tried
+SWAP_LOCK_TIMEOUT = '5s'
+SWAP_ATTEMPTS = 10
+
+# location of the input data file. gzip, bz2 and zstd files are read as they
+# are, see compressed_input.py
 books_data   = 'meta_Books.json'
 reviews_data = 'reviews_Books.json'
 
+# column order of the tuples built by iter_books_data / iter_review_data
+BOOKS_COLUMNS = ('asin', 'title', 'len_title', 'description', 'len_description', 'category',
+                 'price', 'imurl', 'also_viewed', 'also_bought', 'bought_together',
+                 'buy_after_viewing', 'sales_rank_category', 'sales_rank_code', 'len_also_viewed',
+                 'len_also_bought', 'len_bought_together', 'len_buy_after_viewing')
+REVIEWS_COLUMNS = ('asin', 'helpful_count', 'total_helpful_votes', 'helpful_score', 'overall',
+                   'review', 'len_review_character_count', 'review_time', 'reviewer_id',
+                   'reviewer_name', 'summary', 'unix_review_time')
+
+# indexes built after the bulk load, matching the joins and the
+# filter / order of each endpoint in server.py
+INDEXES = [
+    "ALTER TABLE books ADD PRIMARY KEY (asin)",
+    "CREATE INDEX books_price_idx ON books (price, asin)",
+    "CREATE INDEX reviews_asin_idx ON reviews (asin)",
+    "CREATE INDEX reviews_helpful_idx ON reviews (helpful_score DESC, total_helpful_votes DESC)",
+    "CREATE INDEX reviews_unhelpful_idx ON reviews (total_helpful_votes DESC) \
+       WHERE helpful_score = 0",
+    "CREATE INDEX reviews_concise_idx ON reviews (helpful_score DESC, total_helpful_votes DESC) \
+       WHERE len_review_character_count < 40",
+    "CREATE INDEX reviews_review_time_idx ON reviews (review_time)",
+    "CREATE INDEX reviews_asin_helpful_idx ON reviews (asin, helpful_score DESC, \
+       total_helpful_votes DESC, reviewer_id DESC, unix_review_time DESC)",
+    "CREATE UNIQUE INDEX reviews_asin_time_idx ON reviews (asin, unix_review_time, reviewer_id)",
+    "CREATE INDEX books_category_price_idx ON books (category, price, asin)",
+    "CREATE INDEX books_sales_rank_idx ON books (sales_rank_code, asin)",
+    "CREATE INDEX books_category_sales_rank_idx ON books (category, sales_rank_code, asin)",
+    "CREATE INDEX reviews_votes_idx ON reviews (total_helpful_votes DESC)",
+    "CREATE INDEX books_search_idx ON books USING GIN (search_vector)",
+    "CREATE INDEX reviews_search_idx ON reviews USING GIN (search_vector)",
+]
+
+# memory postgres may use per index build. larger sorts finish faster
+INDEX_MAINTENANCE_WORK_MEM = '1GB'
+
+# directory the related items graph is exported to for server.py
+RELATED_GRAPH_DIR = 'related_graph'
+
+# directory `python data_loader.py columnar` writes the columnar export to
+COLUMNAR_DIR = 'columnar'
+
+# sqlite snapshot of the live tables exported after every load, for
+# servers with SNAPSHOT_PATH set. None exports no snapshot
+SNAPSHOT_PATH = None
+
+# how rows are sent to the db: 'copy' streams them with COPY FROM STDIN,
+# 'values' batches them into multi-row INSERT ... VALUES statements (for
+# setups where COPY is unavailable), 'executemany' is one INSERT per row
+LOAD_METHOD = 'copy'
+
+# number of rows parsed and sent to the db at a time. peak memory of the
+# loader is bounded by this, not by the size of the input files
+BATCH_SIZE = 10000
+
+# number of processes used to parse the input files. 0 parses in the loader
+# process itself. each process works on one CHUNK_SIZE byte range at a time
+PARSE_PROCESSES = 0
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# whether rows parsed in parallel are loaded in file order. unordered is
+# faster since a slow chunk doesn't hold up the ones after it
+PARSE_ORDERED = True
+
+# bytes hashed on each side of a file's loaded offset to tell an appended
+# file from a replaced one in incremental mode
+FINGERPRINT_BYTES = 1024 * 1024
+
+# book_stats accumulators held in memory before they are merged into the db
+STATS_FLUSH_BOOKS = 100000
+
+# distinct reviewTime strings whose parse is remembered. the reviews span a
+# few thousand days, so the cache is only ever cleared on unexpected input
+REVIEW_DATE_CACHE_SIZE = 100000
+
+
+def connect():
+    'a connection whose unqualified table names resolve to LOAD_SCHEMA'
+    return psycopg2.connect(dsn=DB_DSN, options='-c search_path=%s' % LOAD_SCHEMA)
+
+def use_schema(schema):
+    'makes the loader functions work on the tables of schema'
+    global LOAD_SCHEMA
+    LOAD_SCHEMA = schema
+
 
 ###############################################################################
 #
@@ -170,6 +290,15 @@ def get_helpful_score(obj):
     else:
         return helpful[0] / float(helpful[1]) if helpful[1] else -1
 
+def get_reviewer_id(obj):
+    'get reviewer id from json object. return '' if the id is not present'
+    try:
+        reviewer_id = obj['reviewerID']
+    except KeyError:
+        return ''
+    else:
+        return reviewer_id
+
 def get_reviewer_name(obj):
     try:
         name = obj['reviewerName']
@@ -186,52 +315,284 @@ def get_reviewer_name(obj):
 ###############################################################################
 
 
+# strict=False lets control characters through in strings, which some of
+# the dumps have
+_json_decoder = json.JSONDecoder(strict=False)
+
+def _unicode_strings(value):
+    'turns the byte strings of a literal_eval result into unicode, as json gives them'
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, list):
+        return [_unicode_strings(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_unicode_strings(k), _unicode_strings(v)) for k, v in value.iteritems())
+    return value
+
+def load_line(line):
+    """
+    parses one line of an input file. json is tried first; the older dumps,
+    the books metadata among them, are python literals instead, which are
+    read with ast.literal_eval rather than the eval their docs suggest
+    """
+    try:
+        return _json_decoder.decode(line)
+    except ValueError:
+        return _unicode_strings(ast.literal_eval(line.strip()))
+
+def transform_book_line(line):
+    'turns one line of the books metadata into a tuple in BOOKS_COLUMNS order'
+    obj               = load_line(line)
+    asin              = get_asin(obj)
+    title             = get_title(obj)
+    description       = get_description(obj)
+    category          = get_category(obj)
+    price             = get_price(obj)
+    imurl             = get_imurl(obj)
+    also_viewed       = get_also_viewed(obj)
+    also_bought       = get_also_bought(obj)
+    bought_together   = get_bought_together(obj)
+    buy_after_viewing = get_buy_after_viewing(obj)
+
+    sales_rank        = get_sales_rank(obj)
+    sales_rank_category = sales_rank[0]
+    sales_rank_code   = sales_rank[1]
+    return (asin, title, len(title), description, len(description), category, price, imurl,
+            also_viewed, also_bought, bought_together, buy_after_viewing,
+            sales_rank_category, sales_rank_code, len(also_viewed), len(also_bought),
+            len(bought_together), len(buy_after_viewing))
+
+def transform_review_line(line):
+    """
+    turns one line of the reviews data into a tuple in REVIEWS_COLUMNS order.
+    the reference for transform_review_line_fast, which the loader uses
+    """
+    obj = load_line(line)
+    asin             = obj['asin']
+    helpful_score    = get_helpful_score(obj)
+    # the dumps have whole ratings as floats (5.0), which COPY won't take
+    # for the int column
+    overall          = int(obj['overall'])
+    review_text      = obj['reviewText']
+    len_review_character_count = len(review_text)
+    review_time      = get_review_time(obj)
+    reviewer_id      = get_reviewer_id(obj)
+    name             = get_reviewer_name(obj)
+    summary          = obj['summary']
+    unix_review_time = obj['unixReviewTime']
+    helpful_count, total_helpful_votes = obj['helpful']
+
+    return (asin, helpful_count, total_helpful_votes, helpful_score, overall, 
+            review_text, len_review_character_count, review_time, reviewer_id, name, summary,
+            unix_review_time)
+
+_review_dates = {}
+
+def parse_review_time(review_time):
+    'get_review_time for a reviewTime string, parsing each distinct date only once'
+    date = _review_dates.get(review_time)
+    if date is None:
+        if len(_review_dates) >= REVIEW_DATE_CACHE_SIZE:
+            _review_dates.clear()
+        date = str(datetime.strptime(review_time, "%m %d, %Y")).split()[0]
+        _review_dates[review_time] = date
+    return date
+
+def transform_review_line_fast(line):
+    """
+    transform_review_line in one pass over the parsed object, with plain dict
+    lookups instead of the get_* helpers and review_time from the memoized
+    parse_review_time. returns the same tuple for the same line
+    """
+    obj = load_line(line)
+    get = obj.get
+    helpful_count, total_helpful_votes = obj['helpful']
+    review_text = obj['reviewText']
+    review_time = get('reviewTime')
+    return (obj['asin'], helpful_count, total_helpful_votes,
+            helpful_count / float(total_helpful_votes) if total_helpful_votes else -1,
+            int(obj['overall']), review_text, len(review_text),
+            parse_review_time(review_time) if review_time is not None else '1900-01-01 00:00:00',
+            get('reviewerID', ''), get('reviewerName'), obj['summary'], obj['unixReviewTime'])
+
+# line transform used for each kind of input file
+TRANSFORMS = {
+    'books': transform_book_line,
+    'reviews': transform_review_line_fast,
+}
+
+def iter_books_data(file_path):
+    """
+    :param file_path: the filename of the books metadata
+    :return: generator of tuples to be inserted into the db, one per line
+    """
+    for line in read_lines(file_path):
+        yield transform_book_line(line)
+
 def transform_books_data(file_path):
-    data = []
-    with open(file_path) as f:
-        for line in f:
-            obj               = json.loads(line)
-            asin              = get_asin(obj)
-            title             = get_title(obj)
-            description       = get_description(obj)
-            category          = get_category(obj)
-            price             = get_price(obj)
-            imurl             = get_imurl(obj)
-            also_viewed       = get_also_viewed(obj)
-            also_bought       = get_also_bought(obj)
-            bought_together   = get_bought_together(obj)
-            buy_after_viewing = get_buy_after_viewing(obj)
-
-            sales_rank        = get_sales_rank(obj)
-            sales_rank_category = sales_rank[0]
-            sales_rank_code   = sales_rank[1]
-            data.append((asin, title, description, category, price, imurl, also_viewed, also_bought, 
-                         bought_together, buy_after_viewing, sales_rank_category, sales_rank_code))
-    return data
+    'reads the whole books file into memory. prefer iter_books_data for big files'
+    return list(iter_books_data(file_path))
+
+def iter_review_data(file_path):
+    """
+    :param file_path: the filename of the data that will be transformed
+    :return: generator of tuples to be inserted into the db, one per line
+    """
+    for line in read_lines(file_path):
+        yield transform_review_line_fast(line)
 
 def transform_review_data(file_path):
+    'reads the whole reviews file into memory. prefer iter_review_data for big files'
+    return list(iter_review_data(file_path))
+
+
+###############################################################################
+#
+# Parallel parsing
+#
+###############################################################################
+
+def file_chunks(file_path, chunk_size=CHUNK_SIZE):
+    """
+    splits a file into (start, end) byte ranges of about chunk_size bytes.
+    every range starts at the beginning of a line and ends just after a
+    newline (or at the end of the file), so no line is split across chunks.
     """
-    :param filename: the filename of the data that will be transformed
-    :return: list of tuples to be inserted into the db
-    """
-    review_data = []    
-    with open(file_path) as f:
-        for line in f:
-            obj = json.loads(line)
-            asin             = obj['asin']
-            helpful_score    = get_helpful_score(obj)
-            overall          = obj['overall']
-            review_text      = obj['reviewText']
-            len_review_character_count = len(review_text)
-            review_time      = get_review_time(obj)
-            name             = get_reviewer_name(obj)
-            summary          = obj['summary']
-            unix_review_time = obj['unixReviewTime']
-            helpful_count, total_helpful_votes = obj['helpful']
-
-            review_data.append((asin, helpful_count, total_helpful_votes, helpful_score, overall, 
-                                review_text, len_review_character_count, review_time, name, summary, unix_review_time))
-    return review_data
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            else:
+                end = size
+            yield (start, end)
+            start = end
+
+def iter_range(file_path, kind, start, end):
+    'transforms every line in the byte range [start, end) of file_path'
+    transform = TRANSFORMS[kind]
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield transform(line)
+
+def parse_chunk(file_path, kind, start, end):
+    return list(iter_range(file_path, kind, start, end))
+
+def parse_text(kind, text):
+    'transforms every line of a block of text, as line_chunks cuts them'
+    transform = TRANSFORMS[kind]
+    return [transform(line) for line in text.split('\n') if line]
+
+def _parse_chunk_worker(args):
+    """
+    runs in the pool. args is a parse function and its arguments. errors are
+    sent back as text so the parent can raise them
+    """
+    parse, parse_args = args
+    try:
+        return parse(*parse_args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+def chunk_tasks(file_path, kind, chunk_size=CHUNK_SIZE):
+    """
+    the work of parsing file_path, as (parse function, arguments) per chunk.
+    workers read the byte ranges of a plain file themselves; a compressed
+    file is decompressed here, in a read_ahead thread, and its text is sent
+    """
+    if compression(file_path) is None:
+        for start, end in file_chunks(file_path, chunk_size):
+            yield parse_chunk, (file_path, kind, start, end)
+    else:
+        for text in read_ahead(line_chunks(iter_blocks(file_path), chunk_size)):
+            yield parse_text, (kind, text)
+
+def _chunk_rows(result):
+    rows, error = result
+    if error is not None:
+        raise ValueError('error parsing chunk:\n' + error)
+    return rows
+
+def iter_parallel(file_path, kind, processes=PARSE_PROCESSES, ordered=PARSE_ORDERED,
+                  chunk_size=CHUNK_SIZE):
+    """
+    transforms file_path in a process pool, one line aligned chunk of
+    chunk_tasks per task, and yields the resulting rows.
+    :param kind: 'books' or 'reviews'
+    :param processes: number of worker processes, the cpu count if 0. the
+        loader only parses in parallel through iter_data when
+        PARSE_PROCESSES is set, so a 0 there parses in the loader instead
+    :param ordered: yield rows in file order. when False, chunks are yielded
+        as soon as any worker finishes, which keeps all workers busy
+    :return: generator of tuples to be inserted into the db
+
+    at most two chunks per worker are in flight at once, so memory stays
+    bounded by chunk_size no matter how large the file is.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    window = 2 * processes
+    pool = multiprocessing.Pool(processes)
+    try:
+        if ordered:
+            pending = deque()
+            for task in chunk_tasks(file_path, kind, chunk_size):
+                pending.append(pool.apply_async(_parse_chunk_worker, (task,)))
+                if len(pending) >= window:
+                    for row in _chunk_rows(pending.popleft().get()):
+                        yield row
+            while pending:
+                for row in _chunk_rows(pending.popleft().get()):
+                    yield row
+        else:
+            done = Queue.Queue()
+            in_flight = 0
+            for task in chunk_tasks(file_path, kind, chunk_size):
+                pool.apply_async(_parse_chunk_worker, (task,), callback=done.put)
+                in_flight += 1
+                if in_flight >= window:
+                    for row in _chunk_rows(done.get()):
+                        yield row
+                    in_flight -= 1
+            while in_flight:
+                for row in _chunk_rows(done.get()):
+                    yield row
+                in_flight -= 1
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def iter_data(file_path, kind, processes=PARSE_PROCESSES, ordered=PARSE_ORDERED):
+    'yields transformed rows, in parallel if processes is set, else in this process'
+    if processes:
+        return iter_parallel(file_path, kind, processes, ordered)
+    if kind == 'books':
+        return iter_books_data(file_path)
+    return iter_review_data(file_path)
+
+def batches(rows, batch_size=BATCH_SIZE):
+    """
+    groups an iterable of rows into lists of at most batch_size rows, so only
+    one batch is ever held in memory.
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def drop_books_table():
     """
@@ -239,7 +600,7 @@ def drop_books_table():
     :return:
     """
     try:
-        con = psycopg2.connect(dsn=DB_DSN)
+        con = connect()
         cur = con.cursor()
         cur.execute("DROP TABLE IF EXISTS books;")
         con.commit()
@@ -256,7 +617,7 @@ def drop_reviews_table():
     :return:
     """
     try:
-        con = psycopg2.connect(dsn=DB_DSN)
+        con = connect()
         cur = con.cursor()
         cur.execute("DROP TABLE IF EXISTS reviews;")
         con.commit()
@@ -290,10 +651,12 @@ def create_books_table():
       len_also_bought, number of items that were also bought 
       len_bought_together, number of items bought together 
       len_buy_after_viewing, number of items bought after viewing 
+      search_vector, weighted full text index of title and description,
+        computed by postgres as rows are loaded
     :return:
     """
     try:
-        con = psycopg2.connect(dsn=DB_DSN)
+        con = connect()
         cur = con.cursor()
         cur.execute("create table books (      \
                        asin text,               \
@@ -313,7 +676,11 @@ def create_books_table():
                        len_also_viewed int,                   \
                        len_also_bought int,                    \
                        len_bought_together int,                 \
-                       len_buy_after_viewing int                 \
+                       len_buy_after_viewing int,                \
+                       search_vector tsvector generated always as ( \
+                         setweight(to_tsvector('english', coalesce(title, '')), 'A') || \
+                         setweight(to_tsvector('english', coalesce(description, '')), 'B') \
+                       ) stored                                     \
                        ); "  
                     )
         con.commit()
@@ -338,10 +705,13 @@ def create_reviews_table():
       reviewer_id, reviewer id
       reviewer_name, reviewer name
       summary, summary of review
+      unix_review_time, time review was submitted as a unix timestamp
+      search_vector, weighted full text index of summary and review text,
+        computed by postgres as rows are loaded
     :return:
     """
     try:
-        con = psycopg2.connect(dsn=DB_DSN)
+        con = connect()
         cur = con.cursor()
         cur.execute("create table reviews (     \
                        asin text,                \
@@ -354,7 +724,12 @@ def create_reviews_table():
                        review_time date,                \
                        reviewer_id text,                 \
                        reviewer_name text,                \
-                       summary text                        \
+                       summary text,                       \
+                       unix_review_time bigint,             \
+                       search_vector tsvector generated always as ( \
+                         setweight(to_tsvector('english', coalesce(summary, '')), 'A') || \
+                         setweight(to_tsvector('english', coalesce(review, '')), 'B') \
+                       ) stored                                     \
                        ); "  
                     )
         con.commit()
@@ -365,37 +740,382 @@ def create_reviews_table():
         cur.close()
         con.close()
 
-def insert_books_data(data):
+def insert_books_data(data, batch_size=BATCH_SIZE):
+    """
+    inserts the data using execute many, batch_size rows at a time
+    :param data: an iterable of tuples in BOOKS_COLUMNS order
+    :return:
+    """
+    load_rows('books', BOOKS_COLUMNS, data, 'executemany', batch_size)
+
+def insert_reviews_data(data, batch_size=BATCH_SIZE):
     """
-    inserts the data using execute many
-    :param data: a list of tuples with order ...
+    inserts the data using execute many, batch_size rows at a time
+    :param data: an iterable of tuples in REVIEWS_COLUMNS order
     :return:
     """
+    load_rows('reviews', REVIEWS_COLUMNS, data, 'executemany', batch_size)
+
+
+def create_indexes():
+    """
+    builds INDEXES on the loaded tables. building them once after the bulk
+    load is much faster than keeping them up to date row by row. an index
+    that fails is reported and the others are still built.
+    :return: True if every index was built
+    """
+    built = False
     try:
-        sql = "INSERT INTO books VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-        conn = psycopg2.connect(dsn=DB_DSN)
-        cur = conn.cursor()
-        cur.executemany(sql, data)
-        conn.commit()
+        con = connect()
+        con.autocommit = True
+        cur = con.cursor()
+        cur.execute("SET maintenance_work_mem = %s;", (INDEX_MAINTENANCE_WORK_MEM,))
+        built = True
+        for sql in INDEXES:
+            try:
+                cur.execute(sql + ";")
+            except psycopg2.Error as e:
+                print e.message
+                built = False
+    except psycopg2.Error as e:
+        print e.message
+        built = False
+
+    else:
+        cur.close()
+        con.close()
+    return built
 
+def analyze_tables():
+    """
+    refreshes planner statistics so the new indexes are used
+    :return:
+    """
+    try:
+        con = connect()
+        con.autocommit = True
+        cur = con.cursor()
+        cur.execute("ANALYZE books;")
+        cur.execute("ANALYZE reviews;")
     except psycopg2.Error as e:
         print e.message
 
     else:
         cur.close()
-        conn.close()
+        con.close()
+
+def create_superlatives_table():
+    """
+    creates a postgres table, if missing, holding one precomputed answer
+    per superlative endpoint in server.py:
+      name, the endpoint name, e.g. most_helpful_review
+      answer, the row the endpoint returns, as json
+      refreshed_at, when the answer was computed
+    :return: True if the table exists
+    """
+    created = False
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute("create table if not exists superlatives ( \
+                       name text primary key,                 \
+                       answer json,                            \
+                       refreshed_at timestamp default now()     \
+                       ); "
+                    )
+        con.commit()
+        created = True
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+    return created
+
+def refresh_superlatives():
+    """
+    recomputes every superlative answer from the books and reviews tables.
+    the old answers are replaced in a single transaction, so the server
+    never sees a partially refreshed table.
+    :return: True if the new answers were stored
+    """
+    refreshed = False
+    try:
+        con = connect()
+        cur = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        answers = []
+        for name in sorted(SUPERLATIVE_QUERIES):
+            cur.execute(SUPERLATIVE_QUERIES[name])
+            # encoded the way the endpoint encodes it, dates included. no
+            # result is stored as {}, so the server doesn't rerun the query
+            answers.append((name, dumps(cur.fetchone() or {})))
+        cur.execute("DELETE FROM superlatives;")
+        cur.executemany("INSERT INTO superlatives (name, answer) VALUES (%s, %s);", answers)
+        con.commit()
+        refreshed = True
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+    return refreshed
+
+def bump_load_generation():
+    """
+    increments the load generation stamp. server.py checks it periodically
+    and drops every cached response computed under an older generation.
+    :return:
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute("create table if not exists load_generation ( \
+                       id int primary key check (id = 1),        \
+                       generation bigint not null,                \
+                       loaded_at timestamp default now()           \
+                       ); "
+                    )
+        cur.execute("INSERT INTO load_generation (id, generation) VALUES (1, 1) \
+                     ON CONFLICT (id) DO UPDATE \
+                     SET generation = load_generation.generation + 1, loaded_at = now();")
+        con.commit()
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+
+def export_related_graph(path=RELATED_GRAPH_DIR):
+    """
+    builds the compact related items graph from the books table and writes
+    it to path, where server.py loads it from at startup.
+    :return:
+    """
+    try:
+        con = connect()
+        graph = RelatedGraph.build(iter_related_rows(con))
+        con.rollback()
+    except psycopg2.Error as e:
+        print e.message
 
-def insert_reviews_data(data):
+    else:
+        con.close()
+        graph.save(path)
+
+def _snapshot_rows(con, table, fetch_size=BATCH_SIZE):
+    'streams the snapshot columns of table through a server side cursor'
+    columns = ["answer::text" if c == 'answer' else c for c in SNAPSHOT_COLUMNS[table]]
+    cur = con.cursor('snapshot_' + table)
+    cur.itersize = fetch_size
+    cur.execute("SELECT %s FROM %s" % (", ".join(columns), table))
+    for row in cur:
+        yield row
+    cur.close()
+
+def export_snapshot(path=SNAPSHOT_PATH):
     """
-    inserts the data using execute many
-    :param data: a list of tuples with order ...
+    writes the served columns of the live tables to the sqlite snapshot at
+    path, replacing it once the new one is complete. every table is read
+    in one repeatable read transaction, so they are consistent with each
+    other and with the load generation stored alongside.
     :return:
     """
     try:
-        sql = "INSERT INTO reviews VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-        conn = psycopg2.connect(dsn=DB_DSN)
+        con = connect()
+        con.set_session(readonly=True, isolation_level='REPEATABLE READ')
+        # sqlite wants text as unicode
+        psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, con)
+        psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY, con)
+        cur = con.cursor()
+        cur.execute("SELECT generation FROM load_generation WHERE id = 1;")
+        row = cur.fetchone()
+        generation = row[0] if row else 0
+        counts = write_snapshot(path, generation,
+                                dict((table, _snapshot_rows(con, table))
+                                     for table in SNAPSHOT_COLUMNS))
+        con.rollback()
+    except psycopg2.Error as e:
+        print e.message
+    except (sqlite3.Error, OSError) as e:
+        print "writing the snapshot failed:", e
+
+    else:
+        cur.close()
+        con.close()
+        for table in sorted(counts):
+            print "snapshot %s: %d rows" % (table, counts[table])
+
+def export_columnar(books_path, reviews_path, out_dir=COLUMNAR_DIR):
+    """
+    parses both input files straight into the typed column files of
+    columnar.py, for columnar_queries.py and other analytics. needs numpy.
+    :return: {table: rows written}, or None if the export failed
+    """
+    if columnar is None:
+        print "the columnar export needs numpy"
+        return None
+    try:
+        counts = columnar.write_columnar(
+            out_dir,
+            batches(iter_data(books_path, 'books')), BOOKS_COLUMNS,
+            batches(iter_data(reviews_path, 'reviews')), REVIEWS_COLUMNS)
+    except (IOError, OSError, ValueError) as e:
+        print "columnar export failed:", e
+        return None
+    for table in sorted(counts):
+        print "columnar %s: %d rows" % (table, counts[table])
+    return counts
+
+###############################################################################
+#
+# Bulk loading
+#
+###############################################################################
+
+def _copy_escape(value):
+    'escapes a str for the COPY text format'
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+def _array_literal(values):
+    'formats a list of strings as a postgres array literal, e.g. {"a","b"}'
+    items = []
+    for v in values:
+        if v is None:
+            items.append('NULL')
+        else:
+            v = v.encode('utf-8') if isinstance(v, unicode) else str(v)
+            items.append('"' + v.replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(items) + '}'
+
+def copy_format_value(value):
+    'formats one python value as a COPY text format field (utf-8 bytes)'
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        return _copy_escape(value.encode('utf-8'))
+    if isinstance(value, str):
+        return _copy_escape(value)
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return _copy_escape(_array_literal(value))
+    return _copy_escape(str(value))
+
+def copy_format_row(row):
+    return '\t'.join([copy_format_value(v) for v in row]) + '\n'
+
+
+class CopyStream(object):
+    """
+    a read only file-like object that formats rows for COPY FROM STDIN as
+    they are read, so cursor.copy_expert can stream a generator of rows
+    without ever building the whole payload in memory.
+    """
+
+    def __init__(self, rows, batch_size=BATCH_SIZE):
+        self._batches = batches(rows, batch_size)
+        self._buf = ''
+        self._pos = 0
+        self.rows = 0
+
+    def _fill(self, size):
+        'makes sure at least size unread bytes are buffered, or all of them if size < 0'
+        while size < 0 or len(self._buf) - self._pos < size:
+            try:
+                batch = next(self._batches)
+            except StopIteration:
+                break
+            self.rows += len(batch)
+            self._buf = self._buf[self._pos:] + ''.join([copy_format_row(r) for r in batch])
+            self._pos = 0
+
+    def _take(self, end):
+        out = self._buf[self._pos:end]
+        self._pos = end
+        return out
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            return self._take(len(self._buf))
+        return self._take(min(self._pos + size, len(self._buf)))
+
+    def readline(self, size=-1):
+        i = self._buf.find('\n', self._pos)
+        while i < 0:
+            buffered = len(self._buf) - self._pos
+            self._fill(buffered + 1)
+            if len(self._buf) - self._pos == buffered:
+                break
+            i = self._buf.find('\n', self._pos)
+        end = len(self._buf) if i < 0 else i + 1
+        if size >= 0:
+            end = min(end, self._pos + size)
+        return self._take(end)
+
+
+def copy_rows(cur, table, columns, rows, batch_size=BATCH_SIZE):
+    """
+    streams rows into table with COPY ... FROM STDIN
+    :return: the number of rows sent
+    """
+    stream = CopyStream(rows, batch_size)
+    sql = "COPY %s (%s) FROM STDIN" % (table, ', '.join(columns))
+    cur.copy_expert(sql, stream, size=65536)
+    return stream.rows
+
+def insert_rows_values(cur, table, columns, rows, batch_size=BATCH_SIZE):
+    """
+    inserts rows with one multi-row INSERT ... VALUES statement per batch
+    :return: the number of rows sent
+    """
+    sql = "INSERT INTO %s (%s) VALUES %%s" % (table, ', '.join(columns))
+    n = 0
+    for batch in batches(rows, batch_size):
+        psycopg2.extras.execute_values(cur, sql, batch, page_size=batch_size)
+        n += len(batch)
+    return n
+
+def insert_rows_executemany(cur, table, columns, rows, batch_size=BATCH_SIZE):
+    """
+    inserts rows with one INSERT statement per row
+    :return: the number of rows sent
+    """
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, ', '.join(columns),
+                                              ', '.join(['%s'] * len(columns)))
+    n = 0
+    for batch in batches(rows, batch_size):
+        cur.executemany(sql, batch)
+        n += len(batch)
+    return n
+
+LOADERS = {
+    'copy': copy_rows,
+    'values': insert_rows_values,
+    'executemany': insert_rows_executemany,
+}
+
+def load_rows(table, columns, rows, method=LOAD_METHOD, batch_size=BATCH_SIZE):
+    """
+    loads an iterable of rows into table in a single transaction using the
+    given method ('copy', 'values' or 'executemany')
+    :return: the number of rows loaded, or None if the load failed
+    """
+    loader = LOADERS[method]
+    n = None
+    try:
+        conn = connect()
+        conn.set_client_encoding('UTF8')
         cur = conn.cursor()
-        cur.executemany(sql, data)
+        n = loader(cur, table, columns, rows, batch_size)
         conn.commit()
 
     except psycopg2.Error as e:
@@ -404,26 +1124,659 @@ def insert_reviews_data(data):
     else:
         cur.close()
         conn.close()
+    return n
 
-if __name__ == '__main__':
-    # running this program as a main file will perform ALL the ETL
-    # it will extract and transform the data from it file
+def load_books_data(data, method=LOAD_METHOD, batch_size=BATCH_SIZE):
+    return load_rows('books', BOOKS_COLUMNS, data, method, batch_size)
+
+# books are loaded without their primary key, which is built afterwards
+# with the other INDEXES. deletes the rows it would fail on: those without
+# an asin, and all but the last loaded copy of a book listed more than
+# once, as an incremental merge would keep
+DEDUPE_BOOKS_SQL = "DELETE FROM books WHERE asin IS NULL OR asin = '' OR ctid IN ( \
+      SELECT ctid FROM (SELECT ctid, row_number() OVER ( \
+                          PARTITION BY asin ORDER BY ctid DESC) n \
+                        FROM books) d \
+      WHERE n > 1)"
+
+def dedupe_books():
+    """
+    removes the books the primary key would reject, see DEDUPE_BOOKS_SQL.
+    run after a full load, before create_indexes.
+    :return: the number of books removed, or None if it failed
+    """
+    n = None
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute(DEDUPE_BOOKS_SQL)
+        removed = cur.rowcount
+        con.commit()
+        n = removed
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+    return n
+
+def load_reviews_data(data, method=LOAD_METHOD, batch_size=BATCH_SIZE):
+    return load_rows('reviews', REVIEWS_COLUMNS, data, method, batch_size)
+
+
+###############################################################################
+#
+# Per-book statistics
+#
+###############################################################################
+
+def drop_book_stats_table():
+    """
+    drops the table 'book_stats' if it exists
+    :return:
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute("DROP TABLE IF EXISTS book_stats;")
+        con.commit()
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+
+def create_book_stats_table():
+    """
+    creates a postgres table, if missing, with the review aggregates of each
+    book. only sums and counts are stored so new reviews can be merged in
+    without looking at the old ones:
+      asin, a unique item identifier
+      review_count, number of reviews
+      overall_sum, sum of the overall scores
+      rating_1 .. rating_5, number of reviews with each overall score
+      helpful_score_sum, sum of helpful_score over reviews that got votes
+      helpful_score_count, number of reviews that got votes
+      first_review_time, date of the earliest review
+      last_review_time, date of the latest review
+    :return:
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute("create table if not exists book_stats ( \
+                       asin text primary key,               \
+                       review_count bigint,                  \
+                       overall_sum float,                     \
+                       rating_1 bigint,                        \
+                       rating_2 bigint,                         \
+                       rating_3 bigint,                          \
+                       rating_4 bigint,                           \
+                       rating_5 bigint,                            \
+                       helpful_score_sum float,                     \
+                       helpful_score_count bigint,                   \
+                       first_review_time date,                        \
+                       last_review_time date                           \
+                       ); "
+                    )
+        con.commit()
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+
+BOOK_STATS_COLUMNS = ('asin', 'review_count', 'overall_sum', 'rating_1', 'rating_2', 'rating_3',
+                      'rating_4', 'rating_5', 'helpful_score_sum', 'helpful_score_count',
+                      'first_review_time', 'last_review_time')
+
+# adds partial aggregates to those already in book_stats
+BOOK_STATS_ON_CONFLICT = "ON CONFLICT (asin) DO UPDATE SET \
+      review_count = book_stats.review_count + EXCLUDED.review_count, \
+      overall_sum = book_stats.overall_sum + EXCLUDED.overall_sum, \
+      rating_1 = book_stats.rating_1 + EXCLUDED.rating_1, \
+      rating_2 = book_stats.rating_2 + EXCLUDED.rating_2, \
+      rating_3 = book_stats.rating_3 + EXCLUDED.rating_3, \
+      rating_4 = book_stats.rating_4 + EXCLUDED.rating_4, \
+      rating_5 = book_stats.rating_5 + EXCLUDED.rating_5, \
+      helpful_score_sum = book_stats.helpful_score_sum + EXCLUDED.helpful_score_sum, \
+      helpful_score_count = book_stats.helpful_score_count + EXCLUDED.helpful_score_count, \
+      first_review_time = LEAST(book_stats.first_review_time, EXCLUDED.first_review_time), \
+      last_review_time = GREATEST(book_stats.last_review_time, EXCLUDED.last_review_time)"
+
+# merges a batch of partial aggregates into book_stats
+BOOK_STATS_UPSERT_SQL = "INSERT INTO book_stats (" + ", ".join(BOOK_STATS_COLUMNS) + ") \
+    VALUES %s " + BOOK_STATS_ON_CONFLICT
+
+# the book_stats columns aggregated over review rows, grouped by asin
+BOOK_STATS_AGGREGATES = "asin, count(*), sum(overall), \
+      count(*) FILTER (WHERE overall = 1), count(*) FILTER (WHERE overall = 2), \
+      count(*) FILTER (WHERE overall = 3), count(*) FILTER (WHERE overall = 4), \
+      count(*) FILTER (WHERE overall = 5), \
+      coalesce(sum(helpful_score) FILTER (WHERE helpful_score >= 0), 0), \
+      count(*) FILTER (WHERE helpful_score >= 0), \
+      min(review_time) FILTER (WHERE review_time > '1900-01-01'), \
+      max(review_time) FILTER (WHERE review_time > '1900-01-01')"
+
+_ASIN = REVIEWS_COLUMNS.index('asin')
+_HELPFUL_SCORE = REVIEWS_COLUMNS.index('helpful_score')
+_OVERALL = REVIEWS_COLUMNS.index('overall')
+_REVIEW_TIME = REVIEWS_COLUMNS.index('review_time')
+
+
+class BookStatsAccumulator(object):
+    """
+    keeps running per-book aggregates of the review rows that stream past
+    it, and merges them into book_stats every max_books books, so memory
+    stays bounded. merging is additive, which is what lets appended review
+    files update the table without a full recompute.
+
+    usage:
+        stats = BookStatsAccumulator()
+        if load_reviews_data(stats.observe(rows)) is not None:
+            stats.commit()
+        else:
+            stats.rollback()
+    """
+
+    def __init__(self, max_books=STATS_FLUSH_BOOKS):
+        self.max_books = max_books
+        self._stats = {}
+        self._con = None
+
+    def observe(self, rows):
+        'passes rows through unchanged, accumulating each one'
+        for row in rows:
+            self.add(row)
+            yield row
+
+    def add(self, row):
+        asin = row[_ASIN]
+        s = self._stats.get(asin)
+        if s is None:
+            # review_count, overall_sum, rating_1..5, helpful sum / count, first, last
+            s = self._stats[asin] = [0, 0.0, 0, 0, 0, 0, 0, 0.0, 0, None, None]
+        overall = row[_OVERALL]
+        s[0] += 1
+        s[1] += overall
+        rating = int(round(overall))
+        if 1 <= rating <= 5:
+            s[1 + rating] += 1
+        helpful_score = row[_HELPFUL_SCORE]
+        if helpful_score >= 0:
+            s[7] += helpful_score
+            s[8] += 1
+        review_time = row[_REVIEW_TIME]
+        if not review_time.startswith('1900-01-01'):
+            if s[9] is None or review_time < s[9]:
+                s[9] = review_time
+            if s[10] is None or review_time > s[10]:
+                s[10] = review_time
+        if len(self._stats) >= self.max_books:
+            self.flush()
+
+    def flush(self):
+        'merges the accumulated aggregates into book_stats, uncommitted'
+        if not self._stats:
+            return
+        if self._con is None:
+            self._con = connect()
+        cur = self._con.cursor()
+        rows = [(asin,) + tuple(s) for asin, s in self._stats.iteritems()]
+        psycopg2.extras.execute_values(cur, BOOK_STATS_UPSERT_SQL, rows, page_size=BATCH_SIZE)
+        cur.close()
+        self._stats = {}
+
+    def commit(self):
+        try:
+            self.flush()
+            if self._con is not None:
+                self._con.commit()
+        except psycopg2.Error as e:
+            print e.message
+        self.close()
+
+    def rollback(self):
+        self._stats = {}
+        if self._con is not None:
+            self._con.rollback()
+        self.close()
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+def load_reviews_with_stats(data, method=LOAD_METHOD, batch_size=BATCH_SIZE):
+    """
+    loads review rows and merges their aggregates into book_stats. the
+    stats are only committed if the reviews loaded successfully.
+    :return: the number of rows loaded, or None if the load failed
+    """
+    stats = BookStatsAccumulator()
+    n = load_reviews_data(stats.observe(data), method, batch_size)
+    if n is None:
+        stats.rollback()
+    else:
+        stats.commit()
+    return n
+
+# a review is identified by (asin, reviewer_id, unix_review_time): keyset
+# paging relies on it being unique and incremental merges skip reviews
+# already loaded by it. deletes all but the first loaded copy of each
+DEDUPE_REVIEWS_SQL = "DELETE FROM reviews WHERE ctid IN ( \
+      SELECT ctid FROM (SELECT ctid, row_number() OVER ( \
+                          PARTITION BY asin, reviewer_id, unix_review_time ORDER BY ctid) n \
+                        FROM reviews) d \
+      WHERE n > 1) \
+    RETURNING asin"
+
+# recomputes the book_stats rows of the given asins from their reviews
+RECOUNT_BOOK_STATS_SQL = "INSERT INTO book_stats (" + ", ".join(BOOK_STATS_COLUMNS) + ") \
+    SELECT " + BOOK_STATS_AGGREGATES + " FROM reviews WHERE asin = ANY(%s) GROUP BY asin \
+    ON CONFLICT (asin) DO UPDATE SET " + \
+    ", ".join("%s = EXCLUDED.%s" % (c, c) for c in BOOK_STATS_COLUMNS[1:])
+
+def dedupe_reviews():
+    """
+    removes the reviews loaded more than once, see DEDUPE_REVIEWS_SQL, and
+    recounts the book_stats of their books, which counted every copy. run
+    after a full load, before the unique index is built.
+    :return: the number of reviews removed, or None if it failed
+    """
+    n = None
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute(DEDUPE_REVIEWS_SQL)
+        removed = cur.rowcount
+        asins = list(set(row[0] for row in cur))
+        if asins:
+            cur.execute(RECOUNT_BOOK_STATS_SQL, (asins,))
+        con.commit()
+        n = removed
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+    return n
+
+
+###############################################################################
+#
+# Incremental loading
+#
+###############################################################################
+
+def create_loaded_files_table():
+    """
+    creates a postgres table, if missing, remembering how far each input
+    file has been loaded:
+      path, the input file
+      file_offset, bytes of the file already loaded, always at a line end
+      fingerprint, md5 of the bytes around file_offset, see file_fingerprint
+      loaded_at, time of the last load
+    :return:
+    """
+    try:
+        con = connect()
+        cur = con.cursor()
+        cur.execute("create table if not exists loaded_files ( \
+                       path text primary key,                 \
+                       file_offset bigint,                     \
+                       fingerprint text,                        \
+                       loaded_at timestamp default now()         \
+                       ); "
+                    )
+        con.commit()
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+
+def last_line_end(file_path):
+    """
+    the offset just past the last newline of the file. a trailing line
+    without a newline may still be being written, so it is left for the
+    next run. compressed files are only ever loaded whole, so for them it
+    is the file size.
+    """
+    if compression(file_path) is not None:
+        return os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            i = f.read(end - start).rfind('\n')
+            if i >= 0:
+                return start + i + 1
+            end = start
+    return 0
+
+def file_fingerprint(file_path, offset):
+    """
+    md5 of the first and of the last FINGERPRINT_BYTES bytes before offset.
+    if it still matches on the next run, the file was appended to rather
+    than replaced, and loading can resume at offset.
+    """
+    h = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        h.update(f.read(min(FINGERPRINT_BYTES, offset)))
+        tail = max(0, offset - FINGERPRINT_BYTES)
+        f.seek(tail)
+        h.update(f.read(offset - tail))
+    return h.hexdigest()
+
+def loaded_offset(cur, file_path):
+    'where loading file_path should resume, 0 if it is new or was replaced'
+    cur.execute("SELECT file_offset, fingerprint FROM loaded_files WHERE path = %s;",
+                (os.path.abspath(file_path),))
+    row = cur.fetchone()
+    if row is None:
+        return 0
+    offset, fingerprint = row
+    if offset > os.path.getsize(file_path) or file_fingerprint(file_path, offset) != fingerprint:
+        return 0
+    return offset
+
+def record_loaded_offset(cur, file_path, offset):
+    cur.execute("INSERT INTO loaded_files (path, file_offset, fingerprint) VALUES (%s, %s, %s) \
+                 ON CONFLICT (path) DO UPDATE SET file_offset = EXCLUDED.file_offset, \
+                   fingerprint = EXCLUDED.fingerprint, loaded_at = now();",
+                (os.path.abspath(file_path), offset, file_fingerprint(file_path, offset)))
+
+def mark_file_loaded(file_path):
+    'records that file_path was loaded in full, e.g. after a full reload'
+    try:
+        con = connect()
+        cur = con.cursor()
+        record_loaded_offset(cur, file_path, last_line_end(file_path))
+        con.commit()
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+
+# upserts staged books on asin, the last occurrence in the file winning
+# when a book appears more than once, and skipping those without an asin. rows whose values didn't change are
+# not rewritten. staged rows are numbered in file order by their seq column
+_BOOK_VALUE_COLUMNS = [c for c in BOOKS_COLUMNS if c != 'asin']
+MERGE_BOOKS_SQL = "INSERT INTO books (" + ", ".join(BOOKS_COLUMNS) + ") \
+    SELECT DISTINCT ON (asin) " + ", ".join(BOOKS_COLUMNS) + " FROM staging_books \
+    WHERE asin <> '' \
+    ORDER BY asin, seq DESC \
+    ON CONFLICT (asin) DO UPDATE SET " + \
+    ", ".join("%s = EXCLUDED.%s" % (c, c) for c in _BOOK_VALUE_COLUMNS) + " \
+    WHERE (" + ", ".join("books." + c for c in _BOOK_VALUE_COLUMNS) + ") \
+      IS DISTINCT FROM (" + ", ".join("EXCLUDED." + c for c in _BOOK_VALUE_COLUMNS) + ")"
+
+# inserts staged reviews not already loaded, deduplicated on
+# (asin, reviewer_id, unix_review_time) keeping the first occurrence, as
+# dedupe_reviews does, and adds only those to book_stats. the reviews
+# insert is the main statement, so its rowcount is the reviews merged
+MERGE_REVIEWS_SQL = "WITH fresh AS ( \
+      SELECT DISTINCT ON (asin, reviewer_id, unix_review_time) " + \
+        ", ".join(REVIEWS_COLUMNS) + " FROM staging_reviews s \
+      WHERE NOT EXISTS (SELECT 1 FROM reviews r \
+                        WHERE r.asin = s.asin AND r.reviewer_id = s.reviewer_id \
+                          AND r.unix_review_time = s.unix_review_time) \
+      ORDER BY asin, reviewer_id, unix_review_time, seq), \
+    stats AS ( \
+      INSERT INTO book_stats (" + ", ".join(BOOK_STATS_COLUMNS) + ") \
+      SELECT " + BOOK_STATS_AGGREGATES + " FROM fresh GROUP BY asin " + \
+      BOOK_STATS_ON_CONFLICT + ") \
+    INSERT INTO reviews (" + ", ".join(REVIEWS_COLUMNS) + ") \
+    SELECT " + ", ".join(REVIEWS_COLUMNS) + " FROM fresh"
+
+INCREMENTAL = {
+    'books': ('books', BOOKS_COLUMNS, MERGE_BOOKS_SQL),
+    'reviews': ('reviews', REVIEWS_COLUMNS, MERGE_REVIEWS_SQL),
+}
+
+def load_incremental(file_path, kind, batch_size=BATCH_SIZE):
+    """
+    loads only the part of file_path not loaded yet, merging it into the
+    existing tables: books are upserted on asin, the last occurrence
+    winning, and reviews already in the db are skipped. the new rows and the new file offset are committed
+    together, so an interrupted run is simply redone.
+    :param kind: 'books' or 'reviews'
+    :return: the number of rows read from the file, or None if the load failed
+    """
+    table, columns, merge_sql = INCREMENTAL[kind]
+    n = None
+    try:
+        con = connect()
+        con.set_client_encoding('UTF8')
+        cur = con.cursor()
+        start = loaded_offset(cur, file_path)
+        end = last_line_end(file_path)
+        if start >= end:
+            print "%s: nothing new since the last load" % file_path
+            n = 0
+        else:
+            if compression(file_path) is None:
+                rows = iter_range(file_path, kind, start, end)
+            else:
+                # a compressed file can't be resumed part way, so a changed one
+                # is merged whole. the merge skips the rows loaded before
+                transform = TRANSFORMS[kind]
+                rows = (transform(line) for line in read_lines(file_path))
+            cur.execute("CREATE TEMP TABLE staging_%s (LIKE %s) ON COMMIT DROP;" % (table, table))
+            # numbers the staged rows in the order they are copied in
+            cur.execute("ALTER TABLE staging_%s ADD COLUMN seq bigserial;" % table)
+            n = copy_rows(cur, 'staging_' + table, columns, rows, batch_size)
+            cur.execute(merge_sql)
+            print "%s: read %d rows, merged %d" % (file_path, n, cur.rowcount)
+            record_loaded_offset(cur, file_path, end)
+        con.commit()
+
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+    return n
 
-    print "transforming data"
-    books_data = transform_books_data(books_data)
-    reviews_date = transform_reviews_data(reviews_data)
+def incremental(books_path, reviews_path):
+    'merges whatever is new in the input files into the existing tables'
+    create_loaded_files_table()
+    create_book_stats_table()
+    changed = False
+    for file_path, kind in ((books_path, 'books'), (reviews_path, 'reviews')):
+        n = load_incremental(file_path, kind)
+        changed = changed or bool(n)
+    if changed:
+        analyze_tables()
+        refresh()
 
-    # drop the db
-    print "dropping table"
-    drop_books_table()
-    drop_reviews_table()
 
-    # create the db
-    print "creating table"
+###############################################################################
+#
+# Zero downtime reload
+#
+###############################################################################
+
+def create_shadow_schema():
+    """
+    creates an empty SHADOW_SCHEMA for a full reload to build its tables in,
+    dropping whatever an earlier, interrupted reload left there
+    :return:
+    """
+    try:
+        con = psycopg2.connect(dsn=DB_DSN)
+        cur = con.cursor()
+        cur.execute("DROP SCHEMA IF EXISTS %s CASCADE;" % SHADOW_SCHEMA)
+        cur.execute("CREATE SCHEMA %s;" % SHADOW_SCHEMA)
+        con.commit()
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+
+def swap_in_shadow_tables(tables=SWAPPED_TABLES):
+    """
+    moves the fully built tables of SHADOW_SCHEMA into LIVE_SCHEMA in one
+    transaction, along with their indexes and statistics. the old tables go
+    to RETIRED_SCHEMA and are dropped afterwards. queries running during the
+    swap finish on the old tables, later ones see the new ones; nothing ever
+    sees a missing or half loaded table.
+    :return: True if the tables were swapped
+    """
+    swapped = False
+    try:
+        con = psycopg2.connect(dsn=DB_DSN)
+        cur = con.cursor()
+        cur.execute("DROP SCHEMA IF EXISTS %s CASCADE;" % RETIRED_SCHEMA)
+        cur.execute("CREATE SCHEMA %s;" % RETIRED_SCHEMA)
+        con.commit()
+
+        for attempt in range(SWAP_ATTEMPTS):
+            try:
+                # don't queue server queries behind a swap waiting on a long query
+                cur.execute("SET LOCAL lock_timeout = %s;", (SWAP_LOCK_TIMEOUT,))
+                for table in tables:
+                    cur.execute("ALTER TABLE IF EXISTS %s.%s SET SCHEMA %s;"
+                                % (LIVE_SCHEMA, table, RETIRED_SCHEMA))
+                    cur.execute("ALTER TABLE %s.%s SET SCHEMA %s;"
+                                % (SHADOW_SCHEMA, table, LIVE_SCHEMA))
+                con.commit()
+                swapped = True
+                break
+            except psycopg2.OperationalError as e:
+                con.rollback()
+                print "swap attempt %d: %s" % (attempt + 1, e.message)
+
+        if swapped:
+            cur.execute("DROP SCHEMA %s CASCADE;" % RETIRED_SCHEMA)
+            cur.execute("DROP SCHEMA %s CASCADE;" % SHADOW_SCHEMA)
+            con.commit()
+    except psycopg2.Error as e:
+        print e.message
+
+    else:
+        cur.close()
+        con.close()
+    return swapped
+
+def refresh():
+    'recomputes the precomputed tables from the data already loaded'
+    print "refreshing superlatives"
+    create_superlatives_table()
+    refresh_superlatives()
+    print "exporting related items graph"
+    export_related_graph()
+    bump_load_generation()
+    if SNAPSHOT_PATH:
+        print "exporting snapshot"
+        export_snapshot(SNAPSHOT_PATH)
+
+def full_reload(books_path, reviews_path):
+    """
+    loads both files from scratch and swaps the result in for the live
+    tables.
+    :return: True if the new data went live
+    """
+    # everything is built in the shadow schema while the server keeps
+    # reading the live tables
+    print "creating shadow tables"
+    create_shadow_schema()
+    use_schema(SHADOW_SCHEMA)
     create_books_table()
     create_reviews_table()
+    create_book_stats_table()
+
+    # transform and insert the data
+    print "transforming and inserting data"
+    if (load_books_data(iter_data(books_path, 'books')) is None or
+            load_reviews_with_stats(iter_data(reviews_path, 'reviews')) is None):
+        print "load failed, the live tables were left as they were"
+        use_schema(LIVE_SCHEMA)
+        return False
+
+    # drop the rows the primary key and unique index would fail on, before
+    # the indexes are built rather than after
+    for kind, dedupe in (('books', dedupe_books), ('reviews', dedupe_reviews)):
+        removed = dedupe()
+        if removed is None:
+            print "removing duplicate %s failed, the live tables were left as they were" % kind
+            use_schema(LIVE_SCHEMA)
+            return False
+        if removed:
+            print "removed %d %s rows their keys would reject" % (removed, kind)
+
+    # index and analyze once everything is in. without its primary key and
+    # indexes the new data is not fit to serve or to merge into later
+    print "creating indexes"
+    if not create_indexes():
+        print "building indexes failed, the live tables were left as they were"
+        use_schema(LIVE_SCHEMA)
+        return False
+    analyze_tables()
+
+    # precompute the answers served by the superlative endpoints
+    print "refreshing superlatives"
+    if not (create_superlatives_table() and refresh_superlatives()):
+        print "refreshing superlatives failed, the live tables were left as they were"
+        use_schema(LIVE_SCHEMA)
+        return False
+
+    # swap the new tables in
+    print "swapping in the new tables"
+    use_schema(LIVE_SCHEMA)
+    if not swap_in_shadow_tables():
+        print "swap failed, the live tables were left as they were"
+        return False
+
+    # remember the files are loaded, for incremental runs
+    create_loaded_files_table()
+    mark_file_loaded(books_path)
+    mark_file_loaded(reviews_path)
+
+    print "exporting related items graph"
+    export_related_graph()
+    bump_load_generation()
+    if SNAPSHOT_PATH:
+        print "exporting snapshot"
+        export_snapshot(SNAPSHOT_PATH)
+    return True
+
+if __name__ == '__main__':
+    # running this program as a main file will perform ALL the ETL
+    # it will extract and transform the data from it file. rows are streamed
+    # from the files into the db BATCH_SIZE at a time.
+    # `python data_loader.py refresh` only recomputes the precomputed tables
+    # `python data_loader.py incremental [books file] [reviews file]` only
+    # loads what is new in the files since the last run
+    # `python data_loader.py snapshot [path]` only exports the sqlite snapshot
+    # `python data_loader.py columnar [books file] [reviews file]` writes the
+    # columnar export to COLUMNAR_DIR instead of loading the db
+    if sys.argv[1:] == ['refresh']:
+        refresh()
+        sys.exit(0)
+    if sys.argv[1:2] == ['snapshot']:
+        export_snapshot(sys.argv[2] if len(sys.argv) > 2 else SNAPSHOT_PATH or 'books.sqlite')
+        sys.exit(0)
+    if sys.argv[1:2] == ['columnar']:
+        paths = sys.argv[2:] + [books_data, reviews_data][len(sys.argv[2:]):]
+        sys.exit(0 if export_columnar(paths[0], paths[1]) is not None else 1)
+    if sys.argv[1:2] == ['incremental']:
+        paths = sys.argv[2:] + [books_data, reviews_data][len(sys.argv[2:]):]
+        incremental(paths[0], paths[1])
+        sys.exit(0)
 
-    # insert the data
-    print "inserting data"
-    insert_books_data(books_data)
-    insert_reviews_data(reviews_data)
+    if not full_reload(books_data, reviews_data):
+        sys.exit(1)
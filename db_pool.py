@@ -0,0 +1,235 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2, psycopg2.extensions, psycopg2.pool
+
+
+# pool sizing. min connections are opened eagerly, up to max are opened on demand
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+
+# seconds a request will wait for a free connection before giving up
+POOL_CHECKOUT_TIMEOUT = 5.0
+
+# idle connections older than this (seconds) are pinged with SELECT 1 on checkout
+POOL_HEALTH_CHECK_INTERVAL = 30.0
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    'raised when no connection could be checked out within the timeout'
+
+
+class ConnectionPool(object):
+    """
+    a thread safe pool of psycopg2 connections shared by every route.
+
+    connections are checked for health when they are handed out, so a
+    connection that was killed by an RDS failover is thrown away and
+    replaced with a fresh one instead of failing the request.
+    """
+
+    def __init__(self, dsn, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 timeout=POOL_CHECKOUT_TIMEOUT,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('invalid pool size: min=%d max=%d' % (min_size, max_size))
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []          # list of (conn, last_used) tuples
+        self._size = 0           # open connections, idle + checked out
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'connects': 0,
+            'health_checks': 0,
+            'health_check_failures': 0,
+            'discarded': 0,
+        }
+
+        for _ in range(min_size):
+            conn = self._connect()
+            self._idle.append((conn, time.time()))
+            self._size += 1
+
+    def _count(self, *names):
+        'adds one to each of the counters in names, under the pool lock'
+        with self._cond:
+            for name in names:
+                self._stats[name] += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(dsn=self.dsn)
+        self._count('connects')
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        'cheap checks first, only ping the server if the connection sat idle'
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.time() - last_used < self.health_check_interval:
+            return True
+        self._count('health_checks')
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        'closes conn. callers count it as discarded'
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """
+        checks out a connection, waiting up to self.timeout seconds if the
+        pool is at max size. raises PoolTimeout if none becomes available.
+        """
+        deadline = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.InterfaceError('connection pool is closed')
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # reserve the slot, connect outside the lock
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                if deadline is None:
+                    deadline = time.time() + self.timeout
+                    self._stats['waits'] += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout('no connection available after %.1fs' % self.timeout)
+                started = time.time()
+                self._cond.wait(remaining)
+                self._stats['wait_time'] += time.time() - started
+
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                self._count('health_check_failures', 'discarded')
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats['checkouts'] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        'returns a connection to the pool, closing it if it is broken'
+        if not close and not conn.closed:
+            try:
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._cond:
+            if close or conn.closed or self._closed:
+                self._discard(conn)
+                self._stats['discarded'] += 1
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        usage:
+            with pool.connection() as conn:
+                cur = conn.cursor()
+        the connection is closed instead of reused if the block raised an
+        OperationalError, since that usually means the server went away.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except psycopg2.extensions.QueryCanceledError:
+            # a statement_timeout, the connection itself is fine
+            self.putconn(conn)
+            raise
+        except psycopg2.OperationalError:
+            self.putconn(conn, close=True)
+            raise
+        except BaseException:
+            # GeneratorExit included, when a streamed page is abandoned
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def stats(self):
+        'returns a dict describing current pool usage, for sizing the pool'
+        with self._cond:
+            out = dict(self._stats)
+            out['size'] = self._size
+            out['idle'] = len(self._idle)
+            out['in_use'] = self._size - len(self._idle)
+            out['min_size'] = self.min_size
+            out['max_size'] = self.max_size
+        return out
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+                self._stats['discarded'] += 1
+                self._size -= 1
+            self._idle = []
+            self._cond.notify_all()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(dsn, **kwargs):
+    """
+    returns the process wide pool, creating it on first use so importing
+    this module never opens a connection. kwargs are passed on to
+    ConnectionPool the first time only.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(dsn, **kwargs)
+    return _pool
+
+def existing_pool():
+    'the process wide pool if get_pool has created it, else None'
+    return _pool
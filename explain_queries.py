@@ -0,0 +1,58 @@
+"""
+prints the postgres EXPLAIN plan of every query behind the server.py
+endpoints, to confirm they use the indexes built by data_loader.py
+rather than sequential scans.
+
+usage: python explain_queries.py [--analyze]
+"""
+import sys
+
+import psycopg2
+
+from data_loader import DB_DSN
+from queries import SUPERLATIVE_QUERIES, SUPERLATIVE_LOOKUP_SQL, SEARCH_QUERIES, SEARCH_CANDIDATES
+from queries import TOP_SOURCES, top_sql
+
+
+def explain(cur, sql, params=None, analyze=False):
+    'returns the plan for sql as a list of lines'
+    prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+    cur.execute(prefix + sql, params)
+    return [row[0] for row in cur.fetchall()]
+
+def uses_seq_scan(plan):
+    return any('Seq Scan' in line for line in plan)
+
+
+if __name__ == '__main__':
+    analyze = '--analyze' in sys.argv[1:]
+
+    conn = psycopg2.connect(dsn=DB_DSN)
+    cur = conn.cursor()
+
+    queries = [('superlative lookup', SUPERLATIVE_LOOKUP_SQL, ('most_helpful_review',))]
+    queries += [(name, SUPERLATIVE_QUERIES[name], None) for name in sorted(SUPERLATIVE_QUERIES)]
+    search_params = {'q': 'history', 'candidates': SEARCH_CANDIDATES, 'limit': 20}
+    queries += [('search ' + kind, SEARCH_QUERIES[kind], search_params)
+                for kind in sorted(SEARCH_QUERIES)]
+    for kind in sorted(TOP_SOURCES):
+        metrics = TOP_SOURCES[kind][2]
+        queries += [('top %s by %s' % (kind, metric),
+                     top_sql(kind, metric, metrics[metric][2], [])[0], (50,))
+                    for metric in sorted(metrics)]
+    queries.append(('top books by price in a category',
+                    top_sql('books', 'price', 'desc', ['category'])[0], ('Books', 50)))
+    queries.append(('top reviews by helpful_score with min_votes',
+                    top_sql('reviews', 'helpful_score', 'desc', ['min_votes'])[0], (10, 50)))
+
+    for name, sql, params in queries:
+        plan = explain(cur, sql, params, analyze)
+        print "*" * 79
+        print "%s%s" % (name, "   <-- SEQ SCAN" if uses_seq_scan(plan) else "")
+        print "*" * 79
+        print "\n".join(plan)
+        print
+        conn.rollback()
+
+    cur.close()
+    conn.close()
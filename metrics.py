@@ -0,0 +1,144 @@
+"""
+per route timing of server.py requests, published in the prometheus text
+format.
+
+a request's time is split into phases: pool_wait (checking out a db
+connection), query (executing sql), fetch (turning result rows into
+dicts), encode (json encoding, gzip and ETag) and total. the phases of a
+request are summed while it runs and observed into one histogram per route
+and phase when it ends.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    'cumulative bucket counts, a sum and a count, like a prometheus histogram'
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        'yields (le, count of observations <= le) for every bucket and +Inf'
+        total = 0
+        for le, n in zip(BUCKETS + ('+Inf',), self.counts):
+            total += n
+            yield le, total
+
+
+class RequestMetrics(object):
+    """
+    histograms of request phase timings and counters of requests and slow
+    queries, keyed by route.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}    # (route, phase) -> Histogram
+        self._requests = {}      # (route, method, status) -> count
+        self._slow_queries = {}  # route -> count
+
+    def observe_request(self, route, method, status, timings):
+        with self._lock:
+            key = (route, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for phase, seconds in timings.iteritems():
+                hist = self._histograms.get((route, phase))
+                if hist is None:
+                    hist = self._histograms[(route, phase)] = Histogram()
+                hist.observe(seconds)
+
+    def count_slow_query(self, route):
+        with self._lock:
+            self._slow_queries[route] = self._slow_queries.get(route, 0) + 1
+
+    def render(self, extra=None):
+        """
+        every metric in the prometheus text exposition format. extra is an
+        optional list of (name, type, help, value) to publish alongside.
+        """
+        lines = []
+        with self._lock:
+            lines.append('# HELP api_request_phase_seconds time spent per request phase')
+            lines.append('# TYPE api_request_phase_seconds histogram')
+            for (route, phase), hist in sorted(self._histograms.items()):
+                labels = 'route="%s",phase="%s"' % (_escape(route), phase)
+                for le, count in hist.cumulative():
+                    lines.append('api_request_phase_seconds_bucket{%s,le="%s"} %d'
+                                 % (labels, le, count))
+                lines.append('api_request_phase_seconds_sum{%s} %.6f' % (labels, hist.sum))
+                lines.append('api_request_phase_seconds_count{%s} %d' % (labels, hist.count))
+
+            lines.append('# HELP api_requests_total requests served')
+            lines.append('# TYPE api_requests_total counter')
+            for (route, method, status), count in sorted(self._requests.items()):
+                lines.append('api_requests_total{route="%s",method="%s",status="%d"} %d'
+                             % (_escape(route), method, status, count))
+
+            lines.append('# HELP api_slow_queries_total queries slower than the slow query threshold')
+            lines.append('# TYPE api_slow_queries_total counter')
+            for route, count in sorted(self._slow_queries.items()):
+                lines.append('api_slow_queries_total{route="%s"} %d' % (_escape(route), count))
+
+        for name, kind, help_text, value in extra or []:
+            if value is None:
+                continue
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def start_request():
+    g.timings = {}
+    g.started_at = time.time()
+
+def request_timings():
+    """
+    the phase timings of the current request so far, with total filled in.
+    empty outside a request or if start_request wasn't called.
+    """
+    if not has_request_context() or 'timings' not in g:
+        return {}
+    timings = dict(g.timings)
+    timings['total'] = time.time() - g.started_at
+    return timings
+
+def record(phase, seconds):
+    'adds seconds to phase of the current request, a no-op outside a request'
+    if has_request_context() and 'timings' in g:
+        g.timings[phase] = g.timings.get(phase, 0.0) + seconds
+
+@contextmanager
+def timed(phase):
+    """
+    usage:
+        with timed('query'):
+            cur.execute(sql)
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(phase, time.time() - started)
@@ -0,0 +1,245 @@
+"""
+sql for the "superlative" endpoints in server.py. the loader runs these once
+per load and stores the answers in the superlatives table, so the routes
+only need a primary key lookup.
+"""
+
+MOST_HELPFUL_REVIEW_SQL = "SELECT b.title title, a.reviewer_name reviewer_name, \
+       a.review most_helpful_review from \
+    (select asin, review, helpful_score, reviewer_name, \
+          total_helpful_votes from reviews) a \
+    left join \
+    (select asin, title from books) b \
+    USING(asin) \
+    order by a.helpful_score desc, a.total_helpful_votes desc \
+    limit 1"
+
+LEAST_HELPFUL_REVIEW_SQL = "SELECT b.title title, a.reviewer_name reviewer_name, \
+       a.review least_helpful_review from \
+    (select asin, review, helpful_score, reviewer_name, \
+          total_helpful_votes from reviews) a \
+    left join \
+    (select asin, title from books) b \
+    USING(asin) \
+    where a.helpful_score = 0 \
+    order by a.total_helpful_votes desc \
+    limit 1"
+
+MOST_CONCISE_GOOD_REVIEW_SQL = "SELECT b.title title, a.reviewer_name reviewer_name, \
+       a.review most_concise_good_review FROM \
+    (SELECT asin, review, helpful_score, reviewer_name, \
+          total_helpful_votes, len_review_character_count FROM reviews) a \
+    left join \
+    (SELECT asin, title from books) b \
+    USING(asin) \
+    where a.len_review_character_count < 40 \
+    ORDER BY a.helpful_score DESC, a.total_helpful_votes desc \
+    LIMIT 1"
+
+MOST_EXPENSIVE_BOOK_SQL = "SELECT title, price \
+    from books \
+    order by price desc \
+    limit 1"
+
+CHEAPEST_BOOK_SQL = "SELECT title, price \
+    from books \
+    where price > -1 \
+    order by price asc \
+    limit 1"
+
+EARLIEST_REVIEW_SQL = "SELECT a.title, b.review_time, b.review from \
+    (select asin, title from books) a \
+     left join \
+    (select asin, review, review_time from reviews) b \
+     using(asin) \
+     where review_time > to_date('1900-01-01', 'YYYY-MM-DD') \
+     order by review_time \
+     limit 1"
+
+# superlative name -> query producing its single row answer
+SUPERLATIVE_QUERIES = {
+    'most_helpful_review': MOST_HELPFUL_REVIEW_SQL,
+    'least_helpful_review': LEAST_HELPFUL_REVIEW_SQL,
+    'most_concise_good_review': MOST_CONCISE_GOOD_REVIEW_SQL,
+    'most_expensive_book': MOST_EXPENSIVE_BOOK_SQL,
+    'cheapest_book': CHEAPEST_BOOK_SQL,
+    'earliest_review': EARLIEST_REVIEW_SQL,
+}
+
+SUPERLATIVE_LOOKUP_SQL = "SELECT answer FROM superlatives WHERE name = %s"
+
+LOAD_GENERATION_SQL = "SELECT generation FROM load_generation WHERE id = 1"
+
+# columns returned when looking books up by asin
+BOOK_DETAIL_COLUMNS = "asin, title, description, category, price, imurl, also_viewed, \
+    also_bought, bought_together, buy_after_viewing, sales_rank_category, sales_rank_code"
+
+# fetches any number of books in one round trip, takes a list of asins
+BOOKS_BY_ASIN_SQL = "SELECT " + BOOK_DETAIL_COLUMNS + " FROM books WHERE asin = ANY(%s)"
+
+# list endpoints page with keyset cursors: each page continues from the sort
+# key of the last row of the previous one, so every page is an index range
+# scan no matter how deep it is.
+# order name -> (ORDER BY clause, keyset comparison, sort key columns)
+BOOK_LIST_COLUMNS = "asin, title, price, category, imurl, sales_rank_code"
+BOOK_LIST_ORDERS = {
+    'price': ("price, asin", ">", ("price", "asin")),
+    'price_desc': ("price DESC, asin DESC", "<", ("price", "asin")),
+    'asin': ("asin", ">", ("asin",)),
+}
+
+REVIEW_LIST_COLUMNS = "asin, reviewer_id, reviewer_name, overall, helpful_count, \
+    total_helpful_votes, helpful_score, summary, review, review_time, unix_review_time"
+REVIEW_LIST_ORDERS = {
+    'helpful': ("helpful_score DESC, total_helpful_votes DESC, reviewer_id DESC, \
+                 unix_review_time DESC", "<",
+                ("helpful_score", "total_helpful_votes", "reviewer_id", "unix_review_time")),
+    'time': ("unix_review_time, reviewer_id", ">", ("unix_review_time", "reviewer_id")),
+    'time_desc': ("unix_review_time DESC, reviewer_id DESC", "<",
+                  ("unix_review_time", "reviewer_id")),
+}
+
+# types a page cursor may hold for each sort key column of the orders above
+LIST_KEY_TYPES = {
+    'asin': basestring,
+    'reviewer_id': basestring,
+    'price': (int, long, float),
+    'helpful_score': (int, long, float),
+    'total_helpful_votes': (int, long),
+    'unix_review_time': (int, long),
+}
+
+def keyset_page_sql(columns, table, order, where=None, after=False):
+    """
+    builds the sql for one page of a keyset paginated list.
+    :param order: an entry of BOOK_LIST_ORDERS / REVIEW_LIST_ORDERS
+    :param where: optional extra condition, e.g. "asin = %s"
+    :param after: whether the page continues from a cursor. the sort key
+        values are then expected as parameters after those of where
+    :return: sql taking the where params, the cursor key (if after) and the limit
+    """
+    order_by, op, key = order
+    conditions = [where] if where else []
+    if after:
+        conditions.append("(%s) %s (%s)" % (", ".join(key), op, ", ".join(["%s"] * len(key))))
+    sql = "SELECT %s FROM %s" % (columns, table)
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    return sql + " ORDER BY %s LIMIT %%s" % order_by
+
+# full text search. matches are found through the GIN index on
+# search_vector and the first SEARCH_CANDIDATES of them, in the order the
+# index returns them, are ranked with ts_rank_cd. the limit has no ORDER BY
+# under it, so the scan stops once it has the candidates: a common word
+# costs no more than SEARCH_CANDIDATES rows instead of a visit to every
+# match. a term with fewer matches than that is ranked exactly; one with
+# more is ranked among the candidates only. storage.SEARCH_TIMEOUT bounds
+# what is left, the GIN posting lists themselves.
+# takes the query text, SEARCH_CANDIDATES and the limit
+SEARCH_CANDIDATES = 5000
+
+SEARCH_BOOKS_SQL = "SELECT asin, title, price, ts_rank_cd(search_vector, q) rank \
+    FROM (SELECT asin, title, price, search_vector FROM books, \
+            websearch_to_tsquery('english', %(q)s) q \
+          WHERE search_vector @@ q \
+          LIMIT %(candidates)s) m, \
+         websearch_to_tsquery('english', %(q)s) q \
+    ORDER BY rank DESC, asin \
+    LIMIT %(limit)s"
+
+SEARCH_REVIEWS_SQL = "SELECT asin, reviewer_name, summary, \
+      ts_headline('english', review, websearch_to_tsquery('english', %(q)s)) snippet, rank FROM \
+    (SELECT asin, reviewer_name, summary, review, ts_rank_cd(search_vector, q) rank \
+       FROM (SELECT asin, reviewer_name, summary, review, search_vector FROM reviews, \
+               websearch_to_tsquery('english', %(q)s) q \
+             WHERE search_vector @@ q \
+             LIMIT %(candidates)s) m, \
+            websearch_to_tsquery('english', %(q)s) q \
+     ORDER BY rank DESC, asin \
+     LIMIT %(limit)s) r \
+    ORDER BY rank DESC, asin"
+
+SEARCH_QUERIES = {
+    'books': SEARCH_BOOKS_SQL,
+    'reviews': SEARCH_REVIEWS_SQL,
+}
+
+BOOK_STATS_SQL = "SELECT review_count, overall_sum, rating_1, rating_2, rating_3, rating_4, \
+    rating_5, helpful_score_sum, helpful_score_count, first_review_time, last_review_time \
+    FROM book_stats WHERE asin = %s"
+
+# top-k rankings. every metric is the leading column of an index built by
+# data_loader.py, so a ranking reads the index in order and stops after k
+# matching rows instead of sorting the table. the filters a metric indexes
+# narrow that walk itself: a range on the metric, or category, the leading
+# column of a (category, metric) index. its other accepted filters are
+# checked row by row, and a selective one could walk most of the index, so
+# they are only applied to the first TOP_SCAN_ROWS rows of the walk: a
+# filter matching fewer than k of those returns fewer than k rows.
+# metric -> (ORDER BY with {dir} for the direction, condition always applied,
+#            default direction, accepted filters, indexed filters)
+TOP_REVIEW_METRICS = {
+    'helpful_score': ("helpful_score {dir}, total_helpful_votes {dir}", "helpful_score >= 0",
+                      'desc', ('min_votes', 'min_len', 'max_len', 'min_overall', 'max_overall'),
+                      ()),
+    'total_helpful_votes': ("total_helpful_votes {dir}", None, 'desc',
+                            ('min_score', 'min_len', 'max_len', 'min_overall', 'max_overall'),
+                            ()),
+    'review_time': ("review_time {dir}", "review_time > '1900-01-01'", 'desc',
+                    ('min_votes', 'min_score', 'min_len', 'max_len', 'min_overall',
+                     'max_overall'), ()),
+}
+
+TOP_BOOK_METRICS = {
+    'price': ("price {dir}, asin {dir}", "price > -1", 'desc',
+              ('category', 'min_price', 'max_price'), ('category', 'min_price', 'max_price')),
+    'sales_rank': ("sales_rank_code {dir}, asin {dir}", "sales_rank_code > 0", 'asc',
+                   ('category', 'min_price', 'max_price'), ('category',)),
+}
+
+# most rows of a metric's index walked to apply the filters it doesn't index
+TOP_SCAN_ROWS = 50000
+
+# filter name -> (condition, type of its value)
+TOP_FILTERS = {
+    'min_votes': ("total_helpful_votes >= %s", int),
+    'min_score': ("helpful_score >= %s", float),
+    'min_len': ("len_review_character_count >= %s", int),
+    'max_len': ("len_review_character_count <= %s", int),
+    'min_overall': ("overall >= %s", int),
+    'max_overall': ("overall <= %s", int),
+    'category': ("category = %s", unicode),
+    'min_price': ("price >= %s", float),
+    'max_price': ("price <= %s", float),
+}
+
+TOP_SOURCES = {
+    'reviews': (REVIEW_LIST_COLUMNS, 'reviews', TOP_REVIEW_METRICS),
+    'books': (BOOK_LIST_COLUMNS, 'books', TOP_BOOK_METRICS),
+}
+
+def top_sql(kind, metric, direction, filters):
+    """
+    builds the sql for the top rows of a ranking.
+    :param kind: 'books' or 'reviews'
+    :param metric: a key of TOP_BOOK_METRICS / TOP_REVIEW_METRICS
+    :param direction: 'asc' or 'desc'
+    :param filters: names of TOP_FILTERS
+    :return: (sql taking the filter values and then k, the filter names in
+        the order the sql takes their values)
+    """
+    columns, table, metrics = TOP_SOURCES[kind]
+    order_by, condition, _, _, indexed = metrics[metric]
+    order_by = order_by.format(dir=direction.upper())
+    walked = [f for f in filters if f in indexed]
+    checked = [f for f in filters if f not in indexed]
+    conditions = ([condition] if condition else []) + [TOP_FILTERS[f][0] for f in walked]
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    if not checked:
+        sql = "SELECT %s FROM %s%s ORDER BY %s LIMIT %%s" % (columns, table, where, order_by)
+    else:
+        sql = "SELECT %s FROM (SELECT * FROM %s%s ORDER BY %s LIMIT %d) walked \
+            WHERE %s ORDER BY %s LIMIT %%s" % (
+                columns, table, where, order_by, TOP_SCAN_ROWS,
+                " AND ".join(TOP_FILTERS[f][0] for f in checked), order_by)
+    return sql, walked + checked
@@ -0,0 +1,199 @@
+"""
+an in-memory index of the related items graph stored in the books table
+(also_viewed, also_bought, bought_together, buy_after_viewing).
+
+asins are mapped to integer ids and each relation type is kept in CSR form:
+the neighbors of node i are targets[offsets[i]:offsets[i + 1]]. both are
+flat arrays of machine ints, so the whole graph takes a few bytes per edge
+and neighborhood queries never touch postgres.
+"""
+import os
+import shutil
+from array import array
+from collections import deque
+
+
+RELATION_TYPES = ('also_viewed', 'also_bought', 'bought_together', 'buy_after_viewing')
+
+# sql yielding rows in the shape RelatedGraph.build expects
+RELATED_ROWS_SQL = "SELECT asin, also_viewed, also_bought, bought_together, buy_after_viewing \
+    FROM books"
+
+
+class RelatedGraph(object):
+
+    def __init__(self, asins, offsets, targets):
+        """
+        :param asins: list of asin strings, indexed by node id
+        :param offsets: {relation type: array of len(asins) + 1 offsets}
+        :param targets: {relation type: array of neighbor node ids}
+        """
+        self.asins = asins
+        self.ids = dict((asin, i) for i, asin in enumerate(asins))
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def build(cls, rows):
+        """
+        builds the graph from rows of (asin, also_viewed, also_bought,
+        bought_together, buy_after_viewing). asins that only appear as
+        neighbors get a node too, with no outgoing edges.
+        """
+        ids = {}
+        asins = []
+
+        def node(asin):
+            i = ids.get(asin)
+            if i is None:
+                i = ids[asin] = len(asins)
+                asins.append(asin)
+            return i
+
+        # edges are first collected in row order, remembering where each
+        # source's run of targets starts, then reordered by node id
+        edges = dict((t, array('i')) for t in RELATION_TYPES)
+        spans = dict((t, {}) for t in RELATION_TYPES)
+        for row in rows:
+            src = node(row[0])
+            for t, related in zip(RELATION_TYPES, row[1:]):
+                if related:
+                    spans[t][src] = (len(edges[t]), len(related))
+                    edges[t].extend(node(asin) for asin in related)
+
+        n = len(asins)
+        offsets = {}
+        targets = {}
+        for t in RELATION_TYPES:
+            off = array('l', [0])
+            tgt = array('i')
+            span = spans[t]
+            dst = edges[t]
+            for i in xrange(n):
+                if i in span:
+                    start, count = span[i]
+                    tgt.extend(dst[start:start + count])
+                off.append(len(tgt))
+            offsets[t] = off
+            targets[t] = tgt
+            edges[t] = None
+        return cls(asins, offsets, targets)
+
+    def __contains__(self, asin):
+        return asin in self.ids
+
+    def __len__(self):
+        return len(self.asins)
+
+    def _neighbor_ids(self, i, relation):
+        off = self.offsets[relation]
+        return self.targets[relation][off[i]:off[i + 1]]
+
+    def neighbors(self, asin, relation):
+        'the asins directly related to asin, in their original order'
+        i = self.ids.get(asin)
+        if i is None:
+            return []
+        return [self.asins[j] for j in self._neighbor_ids(i, relation)]
+
+    def neighborhood(self, asin, relation, depth=1, limit=None):
+        """
+        every asin reachable from asin within depth hops, ranked by hop count
+        and then by score, the number of items on the previous hop that link
+        to it. for also_bought that is a co-purchase count: items bought
+        together with many of this book's co-purchases come first. ties keep
+        the order amazon listed them in.
+        :return: list of (asin, hops, score)
+        """
+        start = self.ids.get(asin)
+        if start is None:
+            return []
+        hops = {start: 0}
+        scores = {}
+        order = []
+        frontier = [start]
+        for hop in xrange(1, depth + 1):
+            found = []
+            for i in frontier:
+                for j in self._neighbor_ids(i, relation):
+                    seen = hops.get(j)
+                    if seen is None:
+                        hops[j] = hop
+                        scores[j] = 1
+                        found.append(j)
+                    elif seen == hop:
+                        scores[j] += 1
+            found.sort(key=lambda j: -scores[j])
+            order.extend(found)
+            frontier = found
+            if not frontier:
+                break
+        if limit is not None:
+            order = order[:limit]
+        return [(self.asins[j], hops[j], scores[j]) for j in order]
+
+    def stats(self):
+        out = {'nodes': len(self.asins)}
+        for t in RELATION_TYPES:
+            out[t + '_edges'] = len(self.targets[t])
+        return out
+
+    def save(self, path):
+        """
+        writes the graph to the directory path, replacing any graph there.
+        it is written to a directory next to path and renamed into place
+        once complete, so a reader never finds a half written graph at path.
+        a directory can't be renamed over another, so the old one is moved
+        aside first; load checks that the files it read belong together.
+        """
+        tmp_path = path + '.tmp'
+        old_path = path + '.old'
+        for p in (tmp_path, old_path):
+            if os.path.exists(p):
+                shutil.rmtree(p)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, 'asins.txt'), 'wb') as f:
+            f.write('\n'.join(self.asins))
+        for t in RELATION_TYPES:
+            with open(os.path.join(tmp_path, t + '.offsets'), 'wb') as f:
+                self.offsets[t].tofile(f)
+            with open(os.path.join(tmp_path, t + '.targets'), 'wb') as f:
+                self.targets[t].tofile(f)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        reads a graph written by save. raises IOError if the files don't
+        belong to the same graph, as when read while save replaced them
+        """
+        with open(os.path.join(path, 'asins.txt'), 'rb') as f:
+            data = f.read()
+        asins = data.split('\n') if data else []
+        offsets = {}
+        targets = {}
+        for t in RELATION_TYPES:
+            offsets[t] = _read_array('l', os.path.join(path, t + '.offsets'))
+            targets[t] = _read_array('i', os.path.join(path, t + '.targets'))
+            if len(offsets[t]) != len(asins) + 1 or offsets[t][-1] != len(targets[t]):
+                raise IOError('the related graph files at %s do not match' % path)
+        return cls(asins, offsets, targets)
+
+
+def _read_array(typecode, file_path):
+    out = array(typecode)
+    with open(file_path, 'rb') as f:
+        out.fromfile(f, os.path.getsize(file_path) // out.itemsize)
+    return out
+
+def iter_related_rows(conn, fetch_size=10000):
+    'streams the related columns of every book through a server side cursor'
+    cur = conn.cursor('related_rows')
+    cur.itersize = fetch_size
+    cur.execute(RELATED_ROWS_SQL)
+    for row in cur:
+        yield row
+    cur.close()
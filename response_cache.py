@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+
+from metrics import timed
+from serialization import EncodedBody
+
+
+# most responses kept in memory, least recently used are evicted first
+CACHE_MAX_ENTRIES = 1024
+
+# default seconds a cached response stays valid
+CACHE_DEFAULT_TTL = 300
+
+# seconds between checks of the load generation in the db
+GENERATION_CHECK_INTERVAL = 5.0
+
+
+class ResponseCache(object):
+    """
+    an LRU cache of response bodies keyed by route and query parameters.
+
+    every entry is stamped with the load generation it was computed under.
+    data_loader.py bumps the generation after each load, and once the cache
+    notices the new value every older entry is treated as a miss.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, generation_source=None,
+                 check_interval=GENERATION_CHECK_INTERVAL):
+        self.max_entries = max_entries
+        self.generation_source = generation_source
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()    # key -> (expires_at, generation, value)
+        self._generation = None
+        self._checked_at = 0
+        self._stats = {}                 # route -> {'hits': n, 'misses': n}
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self):
+        """
+        returns the current load generation, asking generation_source at
+        most once every check_interval seconds. the thread that claims a
+        check asks outside the lock, the others go on with the generation
+        already known.
+        """
+        if self.generation_source is None:
+            return self._generation
+        now = time.time()
+        with self._lock:
+            due = now - self._checked_at >= self.check_interval
+            if due:
+                self._checked_at = now
+        if due:
+            current = self.generation_source()
+            with self._lock:
+                if current is not None and current != self._generation:
+                    if self._generation is not None:
+                        self.invalidations += 1
+                    self._generation = current
+                    self._entries.clear()
+        return self._generation
+
+    def _count(self, route, kind):
+        counts = self._stats.setdefault(route, {'hits': 0, 'misses': 0})
+        counts[kind] += 1
+
+    def get(self, route, key):
+        generation = self.generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, entry_generation, value = entry
+                if expires_at > time.time() and entry_generation == generation:
+                    # move to the most recently used end
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    self._count(route, 'hits')
+                    return value
+                del self._entries[key]
+            self._count(route, 'misses')
+        return None
+
+    def set(self, key, value, ttl):
+        generation = self.generation()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, generation, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            routes = dict((route, dict(counts)) for route, counts in self._stats.items())
+            return {
+                'hits': sum(c['hits'] for c in routes.values()),
+                'misses': sum(c['misses'] for c in routes.values()),
+                'routes': routes,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'generation': self._generation,
+            }
+
+
+def dont_cache():
+    'marks the current response as not cacheable, e.g. because the db query failed'
+    if has_request_context():
+        g.dont_cache = True
+
+def cache_key():
+    'the request path plus its query parameters in a stable order'
+    args = sorted((k, v) for k in request.args for v in request.args.getlist(k))
+    return (request.path, tuple(args))
+
+def cached(cache, ttl=CACHE_DEFAULT_TTL):
+    """
+    decorator for flask routes. successful responses are kept in cache for
+    ttl seconds, pre-encoded with their gzipped body and ETag, and served
+    without calling the route again. clients sending a matching
+    If-None-Match get a 304.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = cache_key()
+            hit = cache.get(f.__name__, key)
+            if hit is not None:
+                return hit.response()
+
+            resp = current_app.make_response(f(*args, **kwargs))
+            if resp.status_code != 200 or g.get('dont_cache'):
+                return resp
+            with timed('encode'):
+                encoded = EncodedBody(resp.get_data(), resp.status_code, resp.mimetype)
+            cache.set(key, encoded, ttl)
+            return encoded.response()
+        return wrapper
+    return decorator
@@ -0,0 +1,95 @@
+"""
+json encoding for server.py responses.
+
+ujson is used when it is installed, it encodes the plain dicts, lists and
+numbers our rows are made of several times faster than the json module
+behind flask's jsonify. dates and decimals are converted the same way
+jsonify would, so the output doesn't depend on which encoder ran.
+"""
+import gzip
+import hashlib
+from cStringIO import StringIO
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import current_app, json, request
+from werkzeug.http import http_date
+
+from metrics import timed
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# bodies smaller than this are not worth gzipping
+MIN_GZIP_SIZE = 512
+GZIP_LEVEL = 6
+
+
+def _plain(obj):
+    'converts the values ujson can not encode, the way flask.json would'
+    if isinstance(obj, dict):
+        return dict((k, _plain(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_plain(v) for v in obj]
+    if isinstance(obj, (date, datetime)):
+        return http_date(obj.timetuple())
+    if isinstance(obj, Decimal):
+        return str(obj)
+    return obj
+
+def dumps(obj):
+    'encodes obj as a json str'
+    if ujson is not None:
+        try:
+            return ujson.dumps(_plain(obj), double_precision=15)
+        except (TypeError, OverflowError, ValueError):
+            pass
+    return json.dumps(obj)
+
+def json_response(obj, status=200):
+    'a drop in replacement for jsonify(obj) using the fast encoder'
+    with timed('encode'):
+        body = dumps(obj)
+    return current_app.response_class(body, status=status, mimetype='application/json')
+
+def gzip_bytes(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class EncodedBody(object):
+    """
+    a response body encoded once, together with its gzipped form and ETag,
+    so serving it again only costs a header comparison and a write.
+    """
+    __slots__ = ('body', 'gzipped', 'etag', 'status', 'mimetype')
+
+    def __init__(self, body, status=200, mimetype='application/json'):
+        self.body = body
+        self.gzipped = gzip_bytes(body) if len(body) >= MIN_GZIP_SIZE else None
+        self.etag = hashlib.md5(body).hexdigest()
+        self.status = status
+        self.mimetype = mimetype
+
+    def response(self):
+        """
+        the response for the current request: 304 if the client already has
+        this body, else the body, gzipped if the client accepts it.
+        """
+        if request.if_none_match.contains(self.etag):
+            resp = current_app.response_class(status=304)
+        elif self.gzipped is not None and request.accept_encodings['gzip']:
+            resp = current_app.response_class(self.gzipped, status=self.status,
+                                              mimetype=self.mimetype)
+            resp.headers['Content-Encoding'] = 'gzip'
+        else:
+            resp = current_app.response_class(self.body, status=self.status,
+                                              mimetype=self.mimetype)
+        resp.set_etag(self.etag)
+        resp.headers['Vary'] = 'Accept-Encoding'
+        return resp
@@ -1,21 +1,287 @@
-from flask import Flask, request, jsonify
-import psycopg2, psycopg2.extras
+import base64
+import os
+import sqlite3
+import threading
+
+from flask import Flask, Response, g, request, json, stream_with_context
+import psycopg2
+
+import metrics
+from metrics import RequestMetrics, timed
+from queries import BOOK_LIST_ORDERS, REVIEW_LIST_ORDERS, LIST_KEY_TYPES, SEARCH_QUERIES
+from queries import TOP_BOOK_METRICS, TOP_REVIEW_METRICS, TOP_FILTERS
+from related_graph import RelatedGraph, RELATION_TYPES
+from response_cache import ResponseCache, cached
+from serialization import dumps, json_response
+from storage import PostgresStorage, SnapshotStorage, StorageError
 
 # DSN location of the AWS - RDS instance
 DB_DSN = "host= dbname= user= password="
 # DB_DSN = "host=localhost dbname=kth user=kth"
+
+# size of the connection pool shared by all routes in this process
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+
+# sqlite snapshot exported by data_loader.py. when set, every route is
+# served from this file instead of postgres and DB_DSN is not used
+SNAPSHOT_PATH = None
+
+# seconds superlative answers are cached. they only change when the loader
+# reruns, which also invalidates the cache, so this can be long
+SUPERLATIVE_TTL = 3600
+
+# seconds a single book lookup is cached
+BOOK_TTL = 600
+
+# most asins that may be fetched in one batch request
+MAX_BATCH_SIZE = 500
+
+# directory data_loader.py exports the related items graph to. if it is
+# missing the graph is built from the books table instead
+RELATED_GRAPH_DIR = 'related_graph'
+
+# deepest and largest neighborhood /books/<asin>/related will compute
+MAX_RELATED_DEPTH = 3
+MAX_RELATED_LIMIT = 1000
+
+# seconds search results are cached, and the most results a search returns
+SEARCH_TTL = 300
+MAX_SEARCH_LIMIT = 100
+
+# rows per page of the list endpoints, and the most a client may ask for
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+# seconds top-k rankings are cached, their default k and the largest allowed
+TOP_TTL = 300
+TOP_K = 10
+MAX_TOP_K = 1000
+
 app = Flask(__name__)
 
+request_metrics = RequestMetrics()
+
+_storage = []
+_storage_lock = threading.Lock()
+
+def storage():
+    """
+    the backend every route reads from, created on first use so importing
+    this module never opens a connection
+    """
+    if not _storage:
+        with _storage_lock:
+            if not _storage:
+                if SNAPSHOT_PATH:
+                    _storage.append(SnapshotStorage(SNAPSHOT_PATH))
+                else:
+                    _storage.append(PostgresStorage(DB_DSN, POOL_MIN_SIZE, POOL_MAX_SIZE,
+                                                    request_metrics))
+    return _storage[0]
+
+def load_generation():
+    'the generation data_loader.py bumps after every load, None if unknown'
+    return storage().generation()
+
+cache = ResponseCache(generation_source=load_generation)
+
+_related = {'graph': None, 'generation': None}
+_related_lock = threading.Lock()
+
+def build_related_graph():
+    if os.path.isdir(RELATED_GRAPH_DIR):
+        return RelatedGraph.load(RELATED_GRAPH_DIR)
+    return storage().related_graph()
+
+def related_graph():
+    """
+    the in-memory related items graph. it is built on first use and rebuilt
+    when the load generation changes; while one request rebuilds it, the
+    others keep answering from the old graph.
+    """
+    generation = cache.generation()
+    graph = _related['graph']
+    if graph is not None and _related['generation'] == generation:
+        return graph
+    if not _related_lock.acquire(graph is None):
+        return graph
+    try:
+        if _related['graph'] is None or _related['generation'] != generation:
+            _related['graph'] = build_related_graph()
+            _related['generation'] = generation
+    except (psycopg2.Error, sqlite3.Error, IOError, OSError) as e:
+        print e
+    finally:
+        _related_lock.release()
+    return _related['graph']
+
+def fetch_answer(name):
+    'the answer the loader precomputed for a superlative endpoint'
+    return storage().superlative(name)
+
+def encode_cursor(row, key):
+    'an opaque page cursor holding the sort key of the last row of a page'
+    return base64.urlsafe_b64encode(json.dumps([row[k] for k in key]))
+
+def decode_cursor(token, key):
+    """
+    returns the sort key values in token, or None if it is not a valid
+    cursor for the key columns: one value of the column's type, see
+    LIST_KEY_TYPES, per column
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != len(key):
+        return None
+    for column, value in zip(key, values):
+        if isinstance(value, bool) or not isinstance(value, LIST_KEY_TYPES[column]):
+            return None
+    return values
+
+def page_args(orders, default_order):
+    """
+    parses order, limit and cursor from the query string.
+    :return: (order, limit, cursor values or None), or an error message
+    """
+    order = request.args.get('order', default_order)
+    if order not in orders:
+        return 'order must be one of: ' + ', '.join(sorted(orders))
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        return 'limit must be an integer'
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return 'limit must be between 1 and %d' % MAX_PAGE_SIZE
+    after = None
+    if 'cursor' in request.args:
+        after = decode_cursor(request.args['cursor'], orders[order][2])
+        if after is None:
+            return 'invalid cursor'
+    return order, limit, after
+
+def top_args(metrics, default_metric):
+    """
+    parses metric, order, k and the filters of a top-k ranking from the
+    query string. only the filters listed for the metric are accepted.
+    :return: (metric, direction, [(filter, value)], k), or an error message
+    """
+    metric = request.args.get('metric', default_metric)
+    if metric not in metrics:
+        return 'metric must be one of: ' + ', '.join(sorted(metrics))
+    _, _, direction, accepted, _ = metrics[metric]
+    direction = request.args.get('order', direction)
+    if direction not in ('asc', 'desc'):
+        return 'order must be asc or desc'
+    try:
+        k = int(request.args.get('k', TOP_K))
+    except ValueError:
+        return 'k must be an integer'
+    if not 1 <= k <= MAX_TOP_K:
+        return 'k must be between 1 and %d' % MAX_TOP_K
+
+    filters = []
+    for name in sorted(request.args):
+        if name in ('metric', 'order', 'k'):
+            continue
+        if name not in accepted:
+            return 'unsupported parameter %s for metric %s, supported filters: %s' % (
+                name, metric, ', '.join(accepted))
+        try:
+            filters.append((name, TOP_FILTERS[name][1](request.args[name])))
+        except ValueError:
+            return 'invalid value for %s' % name
+    return metric, direction, filters, k
+
+def bad_request(message):
+    resp = json_response({'error': message})
+    resp.status_code = 400
+    return resp
+
+def unavailable(message, e):
+    """
+    the response of a route whose query failed: a 503, which isn't cached,
+    rather than an answer that looks like the data doesn't exist
+    """
+    print e
+    resp = json_response({'error': message})
+    resp.status_code = 503
+    return resp
+
+def page_response(field, rows, key, limit):
+    """
+    streams rows as {field: [...], "next_cursor": ...}, next_cursor being
+    null on the last page. rows come from storage().iter_page, which pulls
+    them from a server side cursor a batch at a time, so a page is never
+    held in memory whole; the pooled connection is held until it is sent.
+    the first batch is fetched before the response starts, so a query that
+    fails outright is a 503. once rows are sent a failure can't change the
+    status, so the array is closed and "error" is sent instead of
+    next_cursor, and the page can't be taken for the last one.
+    """
+    try:
+        first = next(rows, None)
+    except StorageError as e:
+        return unavailable('the page could not be fetched', e)
+
+    def generate():
+        yield '{"%s": [' % field
+        count, row, last = 0, first, None
+        try:
+            while row is not None:
+                with timed('encode'):
+                    chunk = (',' if count else '') + dumps(row)
+                yield chunk
+                count, last = count + 1, row
+                row = next(rows, None)
+        except StorageError as e:
+            print e
+            g.status = 500
+            yield '], "error": %s}' % dumps('the page could not be fetched completely')
+            return
+        finally:
+            rows.close()
+        next_cursor = encode_cursor(last, key) if count == limit else None
+        yield '], "next_cursor": %s}' % dumps(next_cursor)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@app.before_request
+def start_timing():
+    metrics.start_request()
+
+@app.after_request
+def note_status(resp):
+    g.status = resp.status_code
+    return resp
+
+@app.teardown_request
+def observe_request(exc):
+    """
+    records the phase timings of the request that just ended. for streamed
+    responses this runs once the stream is done.
+    """
+    timings = metrics.request_timings()
+    if not timings:
+        return
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = 500 if exc is not None else g.get('status', 500)
+    request_metrics.observe_request(route, request.method, status, timings)
+
 
 @app.route('/')
 def default():
 
     output = {"message": "Welcome to the test app!"}
 
-    return jsonify(output)
+    return json_response(output)
 
 
 @app.route('/reviews/most_helpful_review')
+@cached(cache, ttl=SUPERLATIVE_TTL)
 def get_most_helpful_review():
     """
     finds the review with the highest proportion of votes indicating
@@ -23,32 +289,15 @@ def get_most_helpful_review():
     number of votes. Returns the review text, user who submitted the 
     review, and the item asin for which the review was written.
     """
-    out = dict()
-    sql = "SELECT b.title title, a.reviewer_name reviewer_name, \
-               a.review most_helpful_review from \
-            (select asin, review, helpful_score, reviewer_name, \
-                  total_helpful_votes from reviews) a \
-            left join \
-            (select asin, title from books) b \
-            USING(asin) \
-            order by a.helpful_score desc, a.total_helpful_votes desc \
-            limit 1;"
-    try:
-        conn = psycopg2.connect(dsn=DB_DSN)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql)
-        out = cur.fetchall()
-        
-    except psycopg2.Error as e:
-        print e.message
-    else:
-        cur.close()
-        conn.close()
-        out = out[0]
+    try:
+        out = fetch_answer('most_helpful_review')
+    except StorageError as e:
+        return unavailable('the answer could not be fetched', e)
 
-    return jsonify(out)
+    return json_response(out)
 
 @app.route('/reviews/least_helpful_review')
+@cached(cache, ttl=SUPERLATIVE_TTL)
 def get_least_helpful_review():
     """
     finds the review with the smallest proportion of votes indicating
@@ -56,33 +305,15 @@ def get_least_helpful_review():
     number of votes. Returns the review text, user who submitted the 
     review, and the item asin for which the review was written.
     """
+    try:
+        out = fetch_answer('least_helpful_review')
+    except StorageError as e:
+        return unavailable('the answer could not be fetched', e)
 
-    out = dict()
-    sql = "SELECT b.title title, a.reviewer_name reviewer_name, \
-               a.review least_helpful_review from \
-            (select asin, review, helpful_score, reviewer_name, \
-                  total_helpful_votes from reviews) a \
-            left join \
-            (select asin, title from books) b \
-            USING(asin) \
-            where a.helpful_score = 0 \
-            order by a.total_helpful_votes desc \
-            limit 1;"
-    try:
-        conn = psycopg2.connect(dsn=DB_DSN)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql)
-        out = cur.fetchall()
-    except psycopg2.Error as e:
-        print e.message
-    else:
-        cur.close()
-        conn.close()
-        out = out[0]
-
-    return jsonify(out)
+    return json_response(out)
 
 @app.route('/reviews/most_concise_good_review')
+@cached(cache, ttl=SUPERLATIVE_TTL)
 def get_most_concise_helpful_review():
     """
     finds the review with the least number of characters and with the 
@@ -90,117 +321,388 @@ def get_most_concise_helpful_review():
     submitted the review, and the item asin for which the review was 
     written.
     """
+    try:
+        out = fetch_answer('most_concise_good_review')
+    except StorageError as e:
+        return unavailable('the answer could not be fetched', e)
 
-    out = dict()
-    sql = "SELECT b.title title, a.reviewer_name reviewer_name, \
-               a.review most_concise_good_review FROM \
-            (SELECT asin, review, helpful_score, reviewer_name, \
-                  total_helpful_votes, len_review_character_count FROM reviews) a \
-            left join \
-            (SELECT asin, title from books) b \
-            USING(asin) \
-            where a.len_review_character_count < 40 \
-            ORDER BY a.helpful_score DESC, a.total_helpful_votes desc \
-            LIMIT 1;"
-    try:
-        conn = psycopg2.connect(dsn=DB_DSN)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql)
-        out = cur.fetchall()
-        
-    except psycopg2.Error as e:
-        print e.message
-    else:
-        cur.close()
-        conn.close()
-        out = out[0]
-
-    return jsonify(out)
+    return json_response(out)
 
 @app.route('/books/most_expensive_book')
+@cached(cache, ttl=SUPERLATIVE_TTL)
 def get_most_expensive_book():
     """
     finds the book title with the highest price. 
     Returns the title and price of the book.
     """
-
-    out = dict()
-    sql = "SELECT title, price \
-            from books \
-            order by price desc \
-            limit 1;" 
     try:
-        conn = psycopg2.connect(dsn=DB_DSN)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql)
-        out = cur.fetchall()
-        
-    except psycopg2.Error as e:
-        print e.message
-    else:
-        cur.close()
-        conn.close()
-        out = out[0]
+        out = fetch_answer('most_expensive_book')
+    except StorageError as e:
+        return unavailable('the answer could not be fetched', e)
 
-    return jsonify(out)
+    return json_response(out)
 
 @app.route('/books/cheapest_book')
+@cached(cache, ttl=SUPERLATIVE_TTL)
 def get_cheapest_book():
     """
     finds the book title with the lowest price. 
     Returns the title and price of the book.
     """
+    try:
+        out = fetch_answer('cheapest_book')
+    except StorageError as e:
+        return unavailable('the answer could not be fetched', e)
 
-    out = dict()
-    sql = "SELECT title, price \
-            from books \
-            where price > -1 \
-            order by price asc \
-            limit 1;" 
-    try:
-        conn = psycopg2.connect(dsn=DB_DSN)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql)
-        out = cur.fetchall()
-        
-    except psycopg2.Error as e:
-        print e.message
-    else:
-        cur.close()
-        conn.close()
-        out = out[0]
-
-    return jsonify(out)
+    return json_response(out)
 
 @app.route('/reviews/earliest_review')
+@cached(cache, ttl=SUPERLATIVE_TTL)
 def get_earliest_review():
     """
     finds the book with the oldest review in the database. 
     Returns the title, review and date of the review.
     """
-    out = dict()
-    sql = "SELECT a.title, b.review_time, b.review from \
-            (select asin, title from books) a \
-             left join \
-            (select asin, review, review_time from reviews) b \
-             using(asin) \
-             where review_time > to_date('1900-01-01', 'YYYY-MM-DD') \
-             order by review_time \
-             limit 1;" 
-    try:
-        conn = psycopg2.connect(dsn=DB_DSN)
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql)
-        out = cur.fetchall()
-
-    except psycopg2.Error as e:
-        print e.message
+    try:
+        out = fetch_answer('earliest_review')
+    except StorageError as e:
+        return unavailable('the answer could not be fetched', e)
+
+    return json_response(out)
+
+def fetch_books(asins):
+    'fetches every book in asins with a single query. returns {asin: book}'
+    return storage().books(asins)
+
+def batch_asins():
+    """
+    the asins of a batch request, in request order without duplicates. they
+    come either from ?asin=a,b,c (possibly repeated) or from a POST body of
+    the form {"asins": ["a", "b", "c"]}
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        raw = body.get('asins') if isinstance(body, dict) else body
+        if not isinstance(raw, list):
+            return None
     else:
-        cur.close()
-        conn.close()
-        out = out[0]
+        raw = [a for arg in request.args.getlist('asin') for a in arg.split(',')]
+    asins = []
+    seen = set()
+    for asin in raw:
+        if not isinstance(asin, basestring):
+            return None
+        asin = asin.strip()
+        if asin and asin not in seen:
+            seen.add(asin)
+            asins.append(asin)
+    return asins
+
+def get_books_batch():
+    """
+    looks up many books in one round trip. returns the books found, in
+    request order, and the asins that were not found, or a 503 if the
+    lookup failed.
+    """
+    asins = batch_asins()
+    if asins is None:
+        return bad_request('expected a JSON body like {"asins": ["..."]}')
+    if len(asins) > MAX_BATCH_SIZE:
+        return bad_request('at most %d asins per request' % MAX_BATCH_SIZE)
+
+    try:
+        found = fetch_books(asins) if asins else {}
+    except StorageError as e:
+        return unavailable('the books could not be fetched', e)
+    out = {
+        'books': [found[a] for a in asins if a in found],
+        'missing': [a for a in asins if a not in found],
+    }
+
+    return json_response(out)
+
+@app.route('/reviews/top')
+@cached(cache, ttl=TOP_TTL)
+def get_top_reviews():
+    """
+    ranks reviews by a metric.
+    query parameters:
+      metric, one of helpful_score, total_helpful_votes or review_time.
+        defaults to helpful_score
+      order, desc or asc. defaults to desc
+      k, how many reviews to return, defaults to 10
+      min_votes, min_score, min_len, max_len, min_overall, max_overall,
+        optional filters. which ones a metric accepts is listed in
+        queries.TOP_REVIEW_METRICS
+    Returns the top k reviews. every metric is read from its own index, so
+    the cost depends on k, not on the number of reviews. filters are only
+    checked on the first queries.TOP_SCAN_ROWS reviews of the ranking, so a
+    selective one may return fewer than k. a 503 if the query failed.
+    """
+    args = top_args(TOP_REVIEW_METRICS, 'helpful_score')
+    if not isinstance(args, tuple):
+        return bad_request(args)
+    metric, direction, filters, k = args
+
+    try:
+        rows = storage().top('reviews', metric, direction, filters, k)
+    except StorageError as e:
+        return unavailable('the ranking could not be fetched', e)
+    out = {
+        'metric': metric,
+        'order': direction,
+        'filters': dict(filters),
+        'reviews': rows,
+    }
+
+    return json_response(out)
+
+@app.route('/books/top')
+@cached(cache, ttl=TOP_TTL)
+def get_top_books():
+    """
+    ranks books by a metric.
+    query parameters:
+      metric, price or sales_rank. defaults to price
+      order, desc or asc. defaults to desc for price, asc for sales_rank
+      k, how many books to return, defaults to 10
+      category, min_price, max_price, optional filters
+    Returns the top k books, leaving out those without a price or rank.
+    price filters on a sales_rank ranking are only checked on its first
+    queries.TOP_SCAN_ROWS books. a 503 if the query failed.
+    """
+    args = top_args(TOP_BOOK_METRICS, 'price')
+    if not isinstance(args, tuple):
+        return bad_request(args)
+    metric, direction, filters, k = args
+
+    try:
+        rows = storage().top('books', metric, direction, filters, k)
+    except StorageError as e:
+        return unavailable('the ranking could not be fetched', e)
+    out = {
+        'metric': metric,
+        'order': direction,
+        'filters': dict(filters),
+        'books': rows,
+    }
+
+    return json_response(out)
+
+@app.route('/books/<asin>')
+@cached(cache, ttl=BOOK_TTL)
+def get_book(asin):
+    """
+    finds one book by its asin. Returns all of its metadata, a 404 if
+    there is no such book or a 503 if the lookup failed.
+    """
+    try:
+        out = fetch_books([asin]).get(asin)
+    except StorageError as e:
+        return unavailable('the book could not be fetched', e)
+    if out is None:
+        resp = json_response({'error': 'no book with asin %s' % asin})
+        resp.status_code = 404
+        return resp
+
+    return json_response(out)
+
+@app.route('/books/<asin>/stats')
+@cached(cache, ttl=BOOK_TTL)
+def get_book_stats(asin):
+    """
+    review statistics of one book, kept up to date by the loader.
+    Returns the review count, mean overall score, a histogram of overall
+    scores, the mean helpful score of reviews that got votes and the dates
+    of the first and last review. a 404 if the book has no reviews, a 503
+    if the lookup failed.
+    """
+    try:
+        row = storage().book_stats(asin)
+    except StorageError as e:
+        return unavailable('the review statistics could not be fetched', e)
+    if not row:
+        resp = json_response({'error': 'no reviews for asin %s' % asin})
+        resp.status_code = 404
+        return resp
+
+    count = row['review_count']
+    voted = row['helpful_score_count']
+    out = {
+        'asin': asin,
+        'review_count': count,
+        'mean_overall': row['overall_sum'] / count if count else None,
+        'rating_histogram': dict((str(r), row['rating_%d' % r]) for r in range(1, 6)),
+        'mean_helpful_score': row['helpful_score_sum'] / voted if voted else None,
+        'first_review_time': row['first_review_time'],
+        'last_review_time': row['last_review_time'],
+    }
 
-    return jsonify(out)
+    return json_response(out)
+
+@app.route('/books/<asin>/related')
+def get_related_books(asin):
+    """
+    finds the books related to a book, served from the in-memory graph.
+    query parameters:
+      type, one of also_viewed, also_bought, bought_together or
+        buy_after_viewing. defaults to also_bought
+      depth, how many hops to follow, defaults to 1
+      limit, most results to return
+    Returns the related asins ranked by hops, then by how many items on the
+    previous hop link to them.
+    """
+    relation = request.args.get('type', 'also_bought')
+    if relation not in RELATION_TYPES:
+        return bad_request('type must be one of: ' + ', '.join(RELATION_TYPES))
+    try:
+        depth = int(request.args.get('depth', 1))
+        limit = int(request.args.get('limit', MAX_RELATED_LIMIT))
+    except ValueError:
+        return bad_request('depth and limit must be integers')
+    if not 1 <= depth <= MAX_RELATED_DEPTH:
+        return bad_request('depth must be between 1 and %d' % MAX_RELATED_DEPTH)
+    if not 1 <= limit <= MAX_RELATED_LIMIT:
+        return bad_request('limit must be between 1 and %d' % MAX_RELATED_LIMIT)
+
+    graph = related_graph()
+    if graph is None:
+        resp = json_response({'error': 'related items graph is unavailable'})
+        resp.status_code = 503
+        return resp
+    if asin not in graph:
+        resp = json_response({'error': 'no book with asin %s' % asin})
+        resp.status_code = 404
+        return resp
+
+    related = graph.neighborhood(asin, relation, depth, limit)
+    out = {
+        'asin': asin,
+        'type': relation,
+        'depth': depth,
+        'related': [{'asin': a, 'hops': h, 'score': sc} for a, h, sc in related],
+    }
+
+    return json_response(out)
+
+@app.route('/books', methods=['GET', 'POST'])
+def list_books():
+    """
+    lists books one page at a time.
+    query parameters:
+      order, one of price, price_desc or asin. defaults to price
+      limit, rows per page
+      cursor, the next_cursor of the previous page
+    with ?asin=a,b,c, or when POSTed a body of {"asins": [...]}, it instead
+    returns exactly those books, see get_books_batch.
+    """
+    if request.method == 'POST' or 'asin' in request.args:
+        return get_books_batch()
+
+    args = page_args(BOOK_LIST_ORDERS, 'price')
+    if not isinstance(args, tuple):
+        return bad_request(args)
+    order, limit, after = args
+
+    rows = storage().iter_page('books', order, limit, after=after)
+
+    return page_response('books', rows, BOOK_LIST_ORDERS[order][2], limit)
+
+@app.route('/books/<asin>/reviews')
+def list_book_reviews(asin):
+    """
+    lists the reviews of one book one page at a time.
+    query parameters:
+      order, one of helpful, time or time_desc. defaults to helpful
+      limit, rows per page
+      cursor, the next_cursor of the previous page
+    """
+    args = page_args(REVIEW_LIST_ORDERS, 'helpful')
+    if not isinstance(args, tuple):
+        return bad_request(args)
+    order, limit, after = args
+
+    rows = storage().iter_page('reviews', order, limit, asin=asin, after=after)
+
+    return page_response('reviews', rows, REVIEW_LIST_ORDERS[order][2], limit)
+
+@app.route('/search')
+@cached(cache, ttl=SEARCH_TTL)
+def search():
+    """
+    full text search over book titles and descriptions, or over review
+    summaries and text.
+    query parameters:
+      q, the search terms. supports "quoted phrases", or and -excluded words
+      type, books or reviews. defaults to books
+      limit, most results to return, defaults to 20
+    Returns the matches ranked by relevance, title and summary matches
+    weighing more than description and review text. a 503 if search is
+    unavailable or the query failed.
+    """
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('q is required')
+    kind = request.args.get('type', 'books')
+    if kind not in SEARCH_QUERIES:
+        return bad_request('type must be one of: ' + ', '.join(sorted(SEARCH_QUERIES)))
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return bad_request('limit must be an integer')
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        return bad_request('limit must be between 1 and %d' % MAX_SEARCH_LIMIT)
+
+    try:
+        results = storage().search(kind, q, limit)
+    except StorageError as e:
+        return unavailable('the search failed or took too long', e)
+    if results is None:
+        resp = json_response({'error': 'search is unavailable'})
+        resp.status_code = 503
+        return resp
+    out = {'q': q, 'type': kind, 'results': results}
+
+    return json_response(out)
+
+@app.route('/pool/stats')
+def get_pool_stats():
+    """
+    connection pool usage counters, for sizing POOL_MIN_SIZE / POOL_MAX_SIZE,
+    or the connections of the snapshot when serving from one.
+    """
+    return json_response(storage().stats())
+
+@app.route('/cache/stats')
+def get_cache_stats():
+    """
+    response cache hit / miss counters, overall and per route.
+    """
+    return json_response(cache.stats())
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    request phase histograms per route, request and slow query counters,
+    and pool and cache gauges, in the prometheus text format.
+    """
+    pool_stats = storage().stats()
+    cache_stats = cache.stats()
+    extra = [
+        ('db_pool_size', 'gauge', 'open db connections', pool_stats.get('size')),
+        ('db_pool_in_use', 'gauge', 'db connections checked out', pool_stats.get('in_use')),
+        ('db_pool_waits_total', 'counter', 'checkouts that had to wait',
+         pool_stats.get('waits')),
+        ('db_pool_wait_seconds_total', 'counter', 'seconds spent waiting for a connection',
+         pool_stats.get('wait_time')),
+        ('db_pool_timeouts_total', 'counter', 'checkouts that timed out',
+         pool_stats.get('timeouts')),
+        ('response_cache_hits_total', 'counter', 'response cache hits', cache_stats['hits']),
+        ('response_cache_misses_total', 'counter', 'response cache misses',
+         cache_stats['misses']),
+        ('response_cache_entries', 'gauge', 'responses in the cache', cache_stats['entries']),
+    ]
+    return Response(request_metrics.render(extra), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == "__main__":    
     app.run(host='0.0.0.0') 
@@ -0,0 +1,222 @@
+"""
+the read only sqlite snapshot server.py can serve from instead of postgres.
+
+data_loader.py exports the served columns of the live tables into one
+sqlite file: books, reviews, book_stats, superlatives and the load
+generation, with the indexes the routes need and fts5 tables standing in
+for the tsvector search columns. a replica copies the file and answers
+every route from local disk or the page cache.
+"""
+import json
+import os
+import re
+import sqlite3
+
+
+# column order of the rows write_snapshot expects for each table. the list
+# columns of books are stored as json text
+SNAPSHOT_COLUMNS = {
+    'books': ('asin', 'title', 'description', 'category', 'price', 'imurl', 'also_viewed',
+              'also_bought', 'bought_together', 'buy_after_viewing', 'sales_rank_category',
+              'sales_rank_code'),
+    'reviews': ('asin', 'reviewer_id', 'reviewer_name', 'overall', 'helpful_count',
+                'total_helpful_votes', 'helpful_score', 'summary', 'review', 'review_time',
+                'unix_review_time', 'len_review_character_count'),
+    'book_stats': ('asin', 'review_count', 'overall_sum', 'rating_1', 'rating_2', 'rating_3',
+                   'rating_4', 'rating_5', 'helpful_score_sum', 'helpful_score_count',
+                   'first_review_time', 'last_review_time'),
+    'superlatives': ('name', 'answer'),
+}
+
+JSON_COLUMNS = ('also_viewed', 'also_bought', 'bought_together', 'buy_after_viewing')
+
+# date columns are declared as date so sqlite3.PARSE_DECLTYPES reads them
+# back as datetime.date, like psycopg2 does
+SNAPSHOT_SCHEMA = [
+    "CREATE TABLE books (asin text PRIMARY KEY, title text, description text, category text, \
+       price real, imurl text, also_viewed text, also_bought text, bought_together text, \
+       buy_after_viewing text, sales_rank_category text, sales_rank_code integer)",
+    "CREATE TABLE reviews (asin text, reviewer_id text, reviewer_name text, overall integer, \
+       helpful_count integer, total_helpful_votes integer, helpful_score real, summary text, \
+       review text, review_time date, unix_review_time integer, \
+       len_review_character_count integer)",
+    "CREATE TABLE book_stats (asin text PRIMARY KEY, review_count integer, overall_sum real, \
+       rating_1 integer, rating_2 integer, rating_3 integer, rating_4 integer, \
+       rating_5 integer, helpful_score_sum real, helpful_score_count integer, \
+       first_review_time date, last_review_time date)",
+    "CREATE TABLE superlatives (name text PRIMARY KEY, answer text)",
+    "CREATE TABLE meta (key text PRIMARY KEY, value text)",
+]
+
+# built after the rows are in, matching the keyset orders and top-k
+# rankings of queries.py
+SNAPSHOT_INDEXES = [
+    "CREATE INDEX books_price_idx ON books (price, asin)",
+    "CREATE INDEX reviews_asin_helpful_idx ON reviews (asin, helpful_score DESC, \
+       total_helpful_votes DESC, reviewer_id DESC, unix_review_time DESC)",
+    "CREATE INDEX reviews_asin_time_idx ON reviews (asin, unix_review_time, reviewer_id)",
+    "CREATE INDEX books_category_price_idx ON books (category, price, asin)",
+    "CREATE INDEX books_sales_rank_idx ON books (sales_rank_code, asin)",
+    "CREATE INDEX books_category_sales_rank_idx ON books (category, sales_rank_code, asin)",
+    "CREATE INDEX reviews_helpful_idx ON reviews (helpful_score DESC, total_helpful_votes DESC)",
+    "CREATE INDEX reviews_votes_idx ON reviews (total_helpful_votes DESC)",
+    "CREATE INDEX reviews_review_time_idx ON reviews (review_time)",
+]
+
+# full text indexes over the same columns as the search_vector columns in
+# postgres, reading their text from the tables instead of copying it
+SNAPSHOT_FTS = [
+    "CREATE VIRTUAL TABLE books_fts USING fts5(title, description, content='books', \
+       content_rowid='rowid', tokenize='porter unicode61')",
+    "INSERT INTO books_fts (books_fts) VALUES ('rebuild')",
+    "CREATE VIRTUAL TABLE reviews_fts USING fts5(summary, review, content='reviews', \
+       content_rowid='rowid', tokenize='porter unicode61')",
+    "INSERT INTO reviews_fts (reviews_fts) VALUES ('rebuild')",
+]
+
+# rows inserted per executemany call while writing
+WRITE_BATCH_SIZE = 10000
+
+# full text search, like SEARCH_QUERIES in queries.py, titles and summaries
+# weighing more than the text. unlike ts_rank_cd, bm25 is computed from the
+# fts index alone, so every match is ranked and the :candidates best of
+# them are kept. bm25 is lower for better matches, so rank is its
+# negation. takes the fts5 expression of fts_query, the candidates and the
+# limit
+SNAPSHOT_SEARCH_BOOKS_SQL = "SELECT b.asin, b.title, b.price, m.rank \
+    FROM (SELECT rowid, -bm25(books_fts, 10.0, 4.0) rank FROM books_fts \
+          WHERE books_fts MATCH :q \
+          ORDER BY bm25(books_fts, 10.0, 4.0) LIMIT :candidates) m \
+    JOIN books b ON b.rowid = m.rowid \
+    ORDER BY m.rank DESC, b.asin \
+    LIMIT :limit"
+
+# snippets are only made for the rows returned, which needs a second match
+SNAPSHOT_SEARCH_REVIEWS_SQL = "SELECT r.asin, r.reviewer_name, r.summary, \
+      snippet(reviews_fts, 1, '<b>', '</b>', ' ... ', 32) snippet, t.rank \
+    FROM reviews_fts \
+    JOIN (SELECT m.rowid, m.rank \
+          FROM (SELECT rowid, -bm25(reviews_fts, 10.0, 4.0) rank FROM reviews_fts \
+                WHERE reviews_fts MATCH :q \
+                ORDER BY bm25(reviews_fts, 10.0, 4.0) LIMIT :candidates) m \
+          JOIN reviews r ON r.rowid = m.rowid \
+          ORDER BY m.rank DESC, r.asin \
+          LIMIT :limit) t ON reviews_fts.rowid = t.rowid \
+    JOIN reviews r ON r.rowid = t.rowid \
+    WHERE reviews_fts MATCH :q \
+    ORDER BY t.rank DESC, r.asin"
+
+SNAPSHOT_SEARCH_QUERIES = {
+    'books': SNAPSHOT_SEARCH_BOOKS_SQL,
+    'reviews': SNAPSHOT_SEARCH_REVIEWS_SQL,
+}
+
+
+def qmark(sql):
+    'converts the %s placeholders of a query in queries.py to sqlite ones'
+    return sql.replace('%s', '?')
+
+def _json_value(value):
+    return None if value is None else json.dumps(value)
+
+def _insert(con, table, rows):
+    columns = SNAPSHOT_COLUMNS[table]
+    json_at = [i for i, c in enumerate(columns) if c in JSON_COLUMNS]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns),
+                                               ", ".join("?" * len(columns)))
+    n = 0
+    batch = []
+    for row in rows:
+        if json_at:
+            row = list(row)
+            for i in json_at:
+                row[i] = _json_value(row[i])
+        batch.append(row)
+        if len(batch) >= WRITE_BATCH_SIZE:
+            con.executemany(sql, batch)
+            n += len(batch)
+            batch = []
+    if batch:
+        con.executemany(sql, batch)
+        n += len(batch)
+    return n
+
+def write_snapshot(path, generation, tables):
+    """
+    writes a snapshot to path. it is built next to path and renamed over it
+    once complete, so a server reading the old snapshot never sees a half
+    written one.
+    :param generation: the load generation the rows belong to
+    :param tables: {table name: iterable of rows in SNAPSHOT_COLUMNS order}
+    :return: {table name: rows written}
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    con = sqlite3.connect(tmp_path)
+    try:
+        # nothing to protect until the rename, skip the journal
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        for sql in SNAPSHOT_SCHEMA:
+            con.execute(sql)
+        counts = {}
+        for table in sorted(SNAPSHOT_COLUMNS):
+            counts[table] = _insert(con, table, tables.get(table, ()))
+        con.execute("INSERT INTO meta (key, value) VALUES ('generation', ?)",
+                    (str(generation),))
+        for sql in SNAPSHOT_INDEXES:
+            con.execute(sql)
+        try:
+            for sql in SNAPSHOT_FTS:
+                con.execute(sql)
+        except sqlite3.OperationalError as e:
+            # sqlite built without fts5, the snapshot serves everything but search
+            print "full text search left out of the snapshot:", e
+            con.execute("DROP TABLE IF EXISTS books_fts")
+            con.execute("DROP TABLE IF EXISTS reviews_fts")
+        con.execute("ANALYZE")
+        con.commit()
+    finally:
+        con.close()
+    os.rename(tmp_path, path)
+    return counts
+
+
+# search terms the way websearch_to_tsquery reads them: "quoted phrases",
+# words, or between alternatives and a leading - to exclude a term
+_SEARCH_TERM = re.compile(r'(-?)"([^"]*)"?|(-?)(\S+)')
+
+def fts_query(q):
+    """
+    translates a search as accepted by websearch_to_tsquery into an fts5
+    MATCH expression. every term is quoted, so no input is a syntax error.
+    :return: the expression, or None if q has nothing to match on
+    """
+    groups = []          # alternatives joined by or, the groups are and-ed
+    excluded = []
+    join_next = False
+    for m in _SEARCH_TERM.finditer(q):
+        negated = m.group(1) or m.group(3)
+        text = m.group(2) if m.group(2) is not None else m.group(4)
+        if m.group(4) is not None and text.lower() == 'or' and not negated:
+            join_next = bool(groups)
+            continue
+        if not text.strip():
+            continue
+        term = '"%s"' % text.replace('"', '""')
+        if negated:
+            excluded.append(term)
+        elif join_next:
+            groups[-1].append(term)
+        else:
+            groups.append([term])
+        join_next = False
+    if not groups:
+        return None
+    expr = " AND ".join("(%s)" % " OR ".join(g) for g in groups)
+    if excluded:
+        expr = "(%s)" % expr
+    for term in excluded:
+        expr += " NOT " + term
+    return expr
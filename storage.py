@@ -0,0 +1,508 @@
+"""
+where the routes of server.py read their data from.
+
+both backends have the same methods and return rows as dicts shaped the
+same way. PostgresStorage queries the live tables through the connection
+pool. SnapshotStorage answers from a read only sqlite snapshot exported by
+data_loader.py, so a replica can serve from local disk without a network
+hop to the db.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+import psycopg2, psycopg2.extensions, psycopg2.extras
+
+from db_pool import existing_pool, get_pool
+from metrics import record
+from queries import SUPERLATIVE_QUERIES, SUPERLATIVE_LOOKUP_SQL, LOAD_GENERATION_SQL
+from queries import BOOK_LIST_COLUMNS, BOOK_LIST_ORDERS, REVIEW_LIST_COLUMNS, REVIEW_LIST_ORDERS
+from queries import keyset_page_sql, BOOK_DETAIL_COLUMNS, BOOKS_BY_ASIN_SQL, SEARCH_QUERIES
+from queries import SEARCH_CANDIDATES, BOOK_STATS_SQL, top_sql
+from related_graph import RelatedGraph, RELATED_ROWS_SQL, iter_related_rows
+from snapshot import JSON_COLUMNS, SNAPSHOT_SEARCH_QUERIES, fts_query, qmark
+
+
+# queries taking longer than this many seconds are written to SLOW_QUERY_LOG,
+# None turns the slow query log off
+SLOW_QUERY_THRESHOLD = 0.5
+SLOW_QUERY_LOG = 'slow_queries.log'
+
+# whether the plan of a slow query is logged after it. the query is run
+# again under EXPLAIN ANALYZE, for its actual row counts and timings, on a
+# connection of its own in a background thread, so the request doesn't
+# wait for it. the same sql is explained at most once every
+# SLOW_QUERY_EXPLAIN_INTERVAL seconds, one query at a time, and the rerun
+# is cancelled after SLOW_QUERY_EXPLAIN_TIMEOUT seconds
+SLOW_QUERY_EXPLAIN = True
+SLOW_QUERY_EXPLAIN_INTERVAL = 60
+SLOW_QUERY_EXPLAIN_TIMEOUT = 30
+
+# seconds a search query may run before postgres cancels it, see
+# SEARCH_CANDIDATES in queries.py. None leaves it to the server's setting
+SEARCH_TIMEOUT = 2.0
+
+# rows fetched from the server side cursor at a time while streaming a page
+STREAM_FETCH_SIZE = 200
+
+# list name -> (columns, table, orders, extra condition taking the asin)
+PAGE_SOURCES = {
+    'books': (BOOK_LIST_COLUMNS, 'books', BOOK_LIST_ORDERS, None),
+    'reviews': (REVIEW_LIST_COLUMNS, 'reviews', REVIEW_LIST_ORDERS, "asin = %s"),
+}
+
+
+class StorageError(Exception):
+    'a query failed, or the db could not be reached'
+
+
+class Storage(object):
+    'the parts both backends share'
+
+    def fetch_one(self, sql, params=None):
+        'returns the first row of the result, or an empty dict if there is none'
+        rows = self.fetch_all(sql, params)
+        return rows[0] if rows else dict()
+
+    def page_sql(self, kind, order, asin, after):
+        """
+        the sql and params of one page of a list, see iter_page.
+        :return: (sql with %s placeholders, params without the limit)
+        """
+        columns, table, orders, where = PAGE_SOURCES[kind]
+        sql = keyset_page_sql(columns, table, orders[order], where, after=after is not None)
+        params = ([asin] if where else []) + (after or [])
+        return sql, params
+
+    def top(self, kind, metric, direction, filters, k):
+        """
+        the top k rows of a ranking, see queries.top_sql.
+        :param filters: (filter name, value) pairs
+        """
+        values = dict(filters)
+        sql, names = top_sql(kind, metric, direction, [name for name, _ in filters])
+        return self.fetch_all(self.adapt(sql), [values[name] for name in names] + [k])
+
+    def _timed_rows(self, rows, convert=None):
+        """
+        yields the rows of an iterator, recording the time spent waiting on
+        it as the fetch phase, but not the time the caller spends on a row
+        """
+        fetch = 0.0
+        try:
+            while True:
+                started = time.time()
+                row = next(rows, None)
+                fetch += time.time() - started
+                if row is None:
+                    return
+                yield convert(row) if convert else row
+        finally:
+            record('fetch', fetch)
+
+
+class PostgresStorage(Storage):
+
+    def __init__(self, dsn, min_size, max_size, request_metrics=None):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.request_metrics = request_metrics
+        self._slow_log_lock = threading.Lock()
+        self._explained_at = {}    # sql -> when it was last explained
+        self._explaining = False
+
+    def adapt(self, sql):
+        'the queries of queries.py are written for postgres'
+        return sql
+
+    def pool(self):
+        return get_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+    @contextmanager
+    def connection(self):
+        'a pooled connection, the wait for it is timed as the pool_wait phase'
+        started = time.time()
+        with self.pool().connection() as conn:
+            record('pool_wait', time.time() - started)
+            yield conn
+
+    def explain(self, sql, params, route):
+        """
+        starts a background thread logging the EXPLAIN ANALYZE plan of sql,
+        unless sql was explained recently or another explain is running.
+        :return: whether it was started
+        """
+        now = time.time()
+        with self._slow_log_lock:
+            recent = now - self._explained_at.get(sql, 0) < SLOW_QUERY_EXPLAIN_INTERVAL
+            if self._explaining or recent:
+                return False
+            self._explaining = True
+            self._explained_at[sql] = now
+        thread = threading.Thread(target=self._explain, args=(sql, params, route))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _explain(self, sql, params, route):
+        'reruns sql under EXPLAIN ANALYZE on a new read only connection and logs the plan'
+        try:
+            conn = psycopg2.connect(self.dsn)
+            try:
+                conn.set_session(readonly=True)
+                cur = conn.cursor()
+                cur.execute("SET statement_timeout = %s", (int(SLOW_QUERY_EXPLAIN_TIMEOUT * 1000),))
+                query = cur.mogrify(sql, params)
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+            finally:
+                conn.close()
+        except psycopg2.Error as e:
+            print "explaining a slow query failed:", e.message
+        else:
+            self.log_slow_query("%s plan of a slow query, route %s\n%s\n%s\n" % (
+                time.strftime('%Y-%m-%d %H:%M:%S'), route, query.strip(), plan))
+        finally:
+            with self._slow_log_lock:
+                self._explaining = False
+
+    def log_slow_query(self, entry):
+        'appends entry to SLOW_QUERY_LOG, or prints it if there is none'
+        if not SLOW_QUERY_LOG:
+            print entry
+            return
+        with self._slow_log_lock:
+            with open(SLOW_QUERY_LOG, 'a') as f:
+                f.write(entry + '\n')
+
+    def check_slow_query(self, conn, sql, params, seconds):
+        """
+        logs sql to SLOW_QUERY_LOG if it took longer than SLOW_QUERY_THRESHOLD,
+        and has its plan logged after it, see explain. conn must be the
+        connection it ran on.
+        """
+        if SLOW_QUERY_THRESHOLD is None or seconds < SLOW_QUERY_THRESHOLD:
+            return
+        route = request.url_rule.rule if has_request_context() and request.url_rule else None
+        if self.request_metrics is not None:
+            self.request_metrics.count_slow_query(route or 'none')
+        try:
+            query = conn.cursor().mogrify(sql, params)
+        except (psycopg2.Error, TypeError, ValueError, KeyError):
+            query = sql
+        self.log_slow_query("%s slow query, %.3fs, route %s\n%s\n" % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), seconds, route, query.strip()))
+        if SLOW_QUERY_EXPLAIN:
+            self.explain(sql, params, route)
+
+    def fetch_all(self, sql, params=None, timeout=None):
+        """
+        runs sql on a pooled connection and returns the rows as dicts.
+        a query that fails because the server went away (e.g. an RDS failover)
+        is retried once on a fresh connection.
+        raises StorageError if the query fails, so a failure is never taken
+        for a query that found nothing.
+        :param timeout: seconds after which the query is cancelled, a
+            cancelled query isn't retried
+        """
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+                    if timeout is not None:
+                        # only for this transaction, the pool rolls it back
+                        cur.execute("SET LOCAL statement_timeout = %s", (int(timeout * 1000),))
+                    started = time.time()
+                    cur.execute(sql, params)
+                    executed = time.time()
+                    rows = cur.fetchall()
+                    fetched = time.time()
+                    cur.close()
+                    record('query', executed - started)
+                    record('fetch', fetched - executed)
+                    self.check_slow_query(conn, sql, params, fetched - started)
+            except psycopg2.extensions.QueryCanceledError as e:
+                print e.message
+                raise StorageError(e.message)
+            except psycopg2.OperationalError as e:
+                print e.message
+                if attempt:
+                    raise StorageError(e.message)
+            except psycopg2.Error as e:
+                print e.message
+                raise StorageError(e.message)
+            else:
+                return rows
+
+    def generation(self):
+        """
+        the generation data_loader.py bumps after every load, None if unknown.
+        a failed lookup is only logged, not held against the response being
+        served: the cache goes on with the last generation it knew.
+        """
+        try:
+            with self.connection() as conn:
+                cur = conn.cursor()
+                cur.execute(LOAD_GENERATION_SQL)
+                row = cur.fetchone()
+                cur.close()
+        except psycopg2.Error as e:
+            print "load generation lookup failed:", e.message
+            return None
+        return row[0] if row else None
+
+    def superlative(self, name):
+        """
+        looks up the answer the loader precomputed for a superlative endpoint.
+        falls back to running the full query if it hasn't been stored yet.
+        """
+        row = self.fetch_one(SUPERLATIVE_LOOKUP_SQL, (name,))
+        if row:
+            return row['answer']
+        return self.fetch_one(SUPERLATIVE_QUERIES[name])
+
+    def books(self, asins):
+        'fetches every book in asins with a single query. returns {asin: book}'
+        rows = self.fetch_all(BOOKS_BY_ASIN_SQL, (list(asins),))
+        return dict((row['asin'], row) for row in rows)
+
+    def book_stats(self, asin):
+        return self.fetch_one(BOOK_STATS_SQL, (asin,))
+
+    def iter_page(self, kind, order, limit, asin=None, after=None):
+        """
+        yields the rows of one page of a keyset paginated list, pulled from
+        a server side cursor as they are consumed.
+        :param kind: 'books' or 'reviews', the reviews being those of asin
+        :param order: a key of BOOK_LIST_ORDERS / REVIEW_LIST_ORDERS
+        :param after: the sort key values of the last row of the previous page
+        raises StorageError if the query fails.
+        """
+        sql, params = self.page_sql(kind, order, asin, after)
+        params.append(limit)
+        try:
+            with self.connection() as conn:
+                cur = conn.cursor('page', cursor_factory=psycopg2.extras.RealDictCursor)
+                cur.itersize = STREAM_FETCH_SIZE
+                started = time.time()
+                # on a server side cursor execute only declares it, the
+                # query runs as rows are fetched
+                cur.execute(sql, params)
+                record('query', time.time() - started)
+                started = time.time()
+                for row in self._timed_rows(iter(cur)):
+                    yield row
+                cur.close()
+                self.check_slow_query(conn, sql, params, time.time() - started)
+        except psycopg2.Error as e:
+            raise StorageError(e.message)
+
+    def search(self, kind, q, limit):
+        """
+        full text search of books or reviews, ranked by relevance.
+        :return: the matches, or None if search is unavailable
+        raises StorageError if the search fails or runs past SEARCH_TIMEOUT
+        """
+        params = {'q': q, 'candidates': SEARCH_CANDIDATES, 'limit': limit}
+        return self.fetch_all(SEARCH_QUERIES[kind], params, timeout=SEARCH_TIMEOUT)
+
+    def related_graph(self):
+        'builds the related items graph from the books table'
+        with self.connection() as conn:
+            return RelatedGraph.build(iter_related_rows(conn))
+
+    def stats(self):
+        """
+        the pool's usage counters. the pool isn't created for this, so stats
+        still answer while the db is down, without the pool counters if no
+        request has opened the pool yet
+        """
+        pool = existing_pool()
+        out = pool.stats() if pool is not None else {}
+        out['backend'] = 'postgres'
+        return out
+
+
+class SnapshotStorage(Storage):
+    """
+    serves from the sqlite snapshot at path. connections are read only and
+    reused across requests. when data_loader.py renames a new snapshot over
+    path, requests already running finish on the old file and later ones
+    open the new one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._idle = []              # (connection, file id) tuples
+        self._file_id = None         # (inode, mtime) of the snapshot connections open
+        self._generation = None
+        self._has_search = False
+        self._stats = {'connects': 0, 'reopens': 0}
+
+    def adapt(self, sql):
+        return qmark(sql)
+
+    def _current_file_id(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime)
+
+    def _connect(self):
+        if not os.path.exists(self.path):
+            # sqlite would create an empty database instead
+            raise sqlite3.OperationalError('no snapshot at %s' % self.path)
+        con = sqlite3.connect(self.path, check_same_thread=False,
+                              detect_types=sqlite3.PARSE_DECLTYPES)
+        con.execute("PRAGMA query_only = 1")
+        self._stats['connects'] += 1
+        return con
+
+    def _open(self):
+        """
+        notices a new snapshot file: idle connections to the old one are
+        closed and its generation and features are read.
+        """
+        file_id = self._current_file_id()
+        if file_id == self._file_id:
+            return
+        con = self._connect()
+        try:
+            generation = con.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+            has_search = con.execute("SELECT count(*) FROM sqlite_master \
+                                      WHERE name IN ('books_fts', 'reviews_fts')").fetchone()
+        finally:
+            con.close()
+        with self._lock:
+            if self._file_id is not None:
+                self._stats['reopens'] += 1
+            self._file_id = file_id
+            self._generation = int(generation[0]) if generation else None
+            self._has_search = has_search[0] == 2
+            stale, self._idle = self._idle, []
+        for con, _ in stale:
+            con.close()
+
+    @contextmanager
+    def connection(self):
+        started = time.time()
+        if self._file_id is None:
+            self._open()
+        with self._lock:
+            con, file_id = self._idle.pop() if self._idle else (None, self._file_id)
+        if con is None:
+            con = self._connect()
+        record('pool_wait', time.time() - started)
+        try:
+            yield con
+        finally:
+            with self._lock:
+                if file_id == self._file_id:
+                    self._idle.append((con, file_id))
+                    con = None
+            if con is not None:
+                con.close()
+
+    def _dict_rows(self, cur):
+        'turns the rows of cur into dicts, decoding the json list columns'
+        columns = [d[0] for d in cur.description]
+        decode = [c for c in columns if c in JSON_COLUMNS]
+        def convert(row):
+            out = dict(zip(columns, row))
+            for c in decode:
+                if out[c] is not None:
+                    out[c] = json.loads(out[c])
+            return out
+        return convert
+
+    def fetch_all(self, sql, params=()):
+        """
+        runs sql, with ? placeholders, and returns the rows as dicts.
+        raises StorageError if the query fails
+        """
+        try:
+            with self.connection() as con:
+                started = time.time()
+                cur = con.execute(sql, params or ())
+                executed = time.time()
+                convert = self._dict_rows(cur)
+                rows = [convert(row) for row in cur]
+                record('query', executed - started)
+                record('fetch', time.time() - executed)
+        except (sqlite3.Error, OSError) as e:
+            print e
+            raise StorageError(str(e))
+        return rows
+
+    def generation(self):
+        """
+        the generation of the snapshot file, checking whether it was replaced.
+        if the file can't be opened the last generation read is kept
+        """
+        try:
+            self._open()
+        except (sqlite3.Error, OSError) as e:
+            print "snapshot generation lookup failed:", e
+        return self._generation
+
+    def superlative(self, name):
+        row = self.fetch_one("SELECT answer FROM superlatives WHERE name = ?", (name,))
+        return json.loads(row['answer']) if row.get('answer') else dict()
+
+    def books(self, asins):
+        asins = list(asins)
+        if not asins:
+            return {}
+        sql = "SELECT %s FROM books WHERE asin IN (%s)" % (BOOK_DETAIL_COLUMNS,
+                                                          ", ".join("?" * len(asins)))
+        return dict((row['asin'], row) for row in self.fetch_all(sql, asins))
+
+    def book_stats(self, asin):
+        return self.fetch_one(self.adapt(BOOK_STATS_SQL), (asin,))
+
+    def iter_page(self, kind, order, limit, asin=None, after=None):
+        'see PostgresStorage.iter_page'
+        sql, params = self.page_sql(kind, order, asin, after)
+        params.append(limit)
+        try:
+            with self.connection() as con:
+                started = time.time()
+                cur = con.execute(self.adapt(sql), params)
+                record('query', time.time() - started)
+                for row in self._timed_rows(iter(cur), self._dict_rows(cur)):
+                    yield row
+        except (sqlite3.Error, OSError) as e:
+            raise StorageError(str(e))
+
+    def search(self, kind, q, limit):
+        'see PostgresStorage.search'
+        if self._file_id is None:
+            self.generation()
+        if not self._has_search:
+            return None
+        match = fts_query(q)
+        if match is None:
+            return []
+        params = {'q': match, 'candidates': SEARCH_CANDIDATES, 'limit': limit}
+        return self.fetch_all(SNAPSHOT_SEARCH_QUERIES[kind], params)
+
+    def related_graph(self):
+        'builds the related items graph from the books of the snapshot'
+        with self.connection() as con:
+            cur = con.execute(RELATED_ROWS_SQL)
+            return RelatedGraph.build(
+                tuple([row[0]] + [json.loads(v) if v else [] for v in row[1:]])
+                for row in cur)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out['idle'] = len(self._idle)
+        out['backend'] = 'snapshot'
+        out['path'] = self.path
+        out['generation'] = self._generation
+        return out
@@ -0,0 +1,231 @@
+"""
+writes synthetic meta_Books.json and reviews_Books.json files in the format
+data_loader.py parses, for benchmarking without the real amazon dumps.
+
+the data is shaped like the real dumps: fields go missing about as often,
+related lists, salesRank dicts and helpful pairs look the same, and
+popularity is skewed so a few books get most of the reviews and a few
+reviewers write most of them. nothing is kept in memory per book or per
+review, so any scale can be written; --processes writes shards in parallel
+and concatenates them.
+
+usage: python synthetic_data.py --out-dir synthetic --books 100000 \
+           --reviews 1000000 [--skew 3] [--seed 0] [--processes 4]
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import time
+
+
+WORDS = ('the of and a to in is you that it he was for on are as with his they at be this '
+         'have from or one had by word but not what all were we when your can said there use '
+         'an each which she do how their if will up other about out many then them these so '
+         'some her would make like him into time has look two more write go see number no way '
+         'could people my than first water been call who oil its now find long down day did get '
+         'come made may part story novel history mystery love war science life world art').split()
+
+CATEGORIES = [['Books'], ['Books', 'Literature & Fiction'], ['Books', 'History'],
+              ['Books', 'Science & Math'], ['Books', 'Mystery, Thriller & Suspense'],
+              ['Books', "Children's Books"], ['Books', 'Romance']]
+
+# fraction of books missing each optional field, roughly as in meta_Books.json
+MISSING_BOOK_FIELDS = {
+    'title': 0.05,
+    'description': 0.25,
+    'price': 0.3,
+    'imUrl': 0.02,
+    'related': 0.15,
+    'salesRank': 0.1,
+    'categories': 0.01,
+}
+
+# fraction of reviews without a reviewerName
+MISSING_REVIEWER_NAME = 0.02
+
+# share of 1 to 5 star ratings, real reviews skew heavily towards 5
+RATING_WEIGHTS = [0.05, 0.05, 0.1, 0.22, 0.58]
+
+# reviews are spread from 1996 to mid 2014, more of them towards the end
+FIRST_REVIEW_TIME = 820454400
+LAST_REVIEW_TIME = 1406073600
+
+# lines written between progress reports
+PROGRESS_EVERY = 1000000
+
+# the random generator is reseeded every SEED_BLOCK lines, and shards are
+# whole blocks, so the output is the same for any number of processes
+SEED_BLOCK = 100000
+
+
+def asin_for(i):
+    'a deterministic 10 character asin for book number i'
+    return '%010d' % (1000000000 + i)
+
+def skewed_index(rng, n, skew):
+    """
+    a random index in [0, n) where low indexes are much more likely, so a
+    few items get most of the picks. skew 1 is uniform, larger is steeper.
+    """
+    return min(n - 1, int(n * rng.random() ** skew))
+
+def scramble(i, n):
+    """
+    maps popularity rank i to an item number, a bijection on [0, n), so the
+    popular items are spread over the asin range instead of being the first
+    ones. 2654435761 is prime so it is coprime with any n it doesn't divide.
+    """
+    p = 2654435761
+    if n % p == 0:
+        return i
+    return (i * p) % n
+
+def popular(rng, n, skew):
+    return scramble(skewed_index(rng, n, skew), n)
+
+def sentence(rng, n_words):
+    return ' '.join(rng.choice(WORDS) for _ in xrange(n_words)).capitalize() + '.'
+
+def text(rng, mean_sentences):
+    'a paragraph with a log-normally distributed number of sentences'
+    n = max(1, int(rng.lognormvariate(math.log(mean_sentences), 0.8)))
+    return ' '.join(sentence(rng, rng.randint(3, 20)) for _ in xrange(n))
+
+def fake_book(rng, i, n_books, skew):
+    book = {'asin': asin_for(i)}
+    if rng.random() > MISSING_BOOK_FIELDS['title']:
+        book['title'] = sentence(rng, rng.randint(1, 8))
+    if rng.random() > MISSING_BOOK_FIELDS['description']:
+        book['description'] = text(rng, 4)
+    if rng.random() > MISSING_BOOK_FIELDS['price']:
+        book['price'] = round(rng.lognormvariate(2.6, 0.7), 2)
+    if rng.random() > MISSING_BOOK_FIELDS['imUrl']:
+        book['imUrl'] = 'http://ecx.images-amazon.com/images/I/%s.jpg' % book['asin']
+    if rng.random() > MISSING_BOOK_FIELDS['related']:
+        related = {}
+        for key, mean in (('also_bought', 20), ('also_viewed', 15), ('bought_together', 2),
+                          ('buy_after_viewing', 4)):
+            # each list is present about half the time, and points at popular books
+            if rng.random() < 0.5:
+                n = max(1, min(100, int(rng.expovariate(1.0 / mean))))
+                related[key] = [asin_for(popular(rng, n_books, skew)) for _ in xrange(n)]
+        if related:
+            book['related'] = related
+    if rng.random() > MISSING_BOOK_FIELDS['salesRank']:
+        book['salesRank'] = {'Books': min(10 ** 7, int(rng.paretovariate(0.5) * 1000))}
+    if rng.random() > MISSING_BOOK_FIELDS['categories']:
+        book['categories'] = [rng.choice(CATEGORIES)]
+    return book
+
+def fake_review(rng, n_books, n_reviewers, skew):
+    # most reviews get no votes, a few get very many
+    total = min(10000, int(rng.paretovariate(1.2)) - 1) if rng.random() < 0.4 else 0
+    helpful = rng.randint(0, total) if total else 0
+    # weighted towards recent years
+    unix_time = int(FIRST_REVIEW_TIME +
+                    (LAST_REVIEW_TIME - FIRST_REVIEW_TIME) * rng.random() ** 0.4)
+    unix_time -= unix_time % 86400
+    reviewer = popular(rng, n_reviewers, skew)
+    review = {
+        'reviewerID': 'A%013d' % reviewer,
+        'asin': asin_for(popular(rng, n_books, skew)),
+        'helpful': [helpful, total],
+        'reviewText': text(rng, 5) if rng.random() > 0.001 else '',
+        'overall': float(_weighted_choice(rng, RATING_WEIGHTS) + 1),
+        'summary': sentence(rng, rng.randint(1, 6)),
+        'unixReviewTime': unix_time,
+        'reviewTime': time.strftime('%m %d, %Y', time.gmtime(unix_time)).replace(' 0', ' '),
+    }
+    if rng.random() > MISSING_REVIEWER_NAME:
+        review['reviewerName'] = 'reviewer %d' % reviewer
+    return review
+
+def _weighted_choice(rng, weights):
+    r = rng.random()
+    for i, w in enumerate(weights):
+        r -= w
+        if r < 0:
+            return i
+    return len(weights) - 1
+
+
+def write_lines(path, kind, start, stop, n_books, n_reviewers, skew, seed):
+    """
+    writes books start..stop (or that many reviews) to path, one json object
+    per line. start must be a multiple of SEED_BLOCK.
+    """
+    rng = random.Random()
+    with open(path, 'wb', 1024 * 1024) as f:
+        for i in xrange(start, stop):
+            if i % SEED_BLOCK == 0:
+                rng.seed('%s-%s-%d' % (seed, kind, i))
+            if kind == 'books':
+                obj = fake_book(rng, i, n_books, skew)
+            else:
+                obj = fake_review(rng, n_books, n_reviewers, skew)
+            f.write(json.dumps(obj) + '\n')
+            if (i + 1) % PROGRESS_EVERY == 0:
+                print "%s: %d lines" % (kind, i + 1)
+                sys.stdout.flush()
+    return path
+
+def _write_shard(args):
+    return write_lines(*args)
+
+def write_file(path, kind, n_lines, n_books, n_reviewers, skew, seed, processes=1):
+    'writes n_lines of kind to path, in parallel shards if processes > 1'
+    if processes <= 1:
+        return write_lines(path, kind, 0, n_lines, n_books, n_reviewers, skew, seed)
+
+    blocks = int(math.ceil(n_lines / float(SEED_BLOCK)))
+    shard = int(math.ceil(blocks / float(processes))) * SEED_BLOCK
+    shards = [('%s.part%d' % (path, k), kind, start, min(n_lines, start + shard),
+               n_books, n_reviewers, skew, seed)
+              for k, start in enumerate(xrange(0, n_lines, shard))]
+    pool = multiprocessing.Pool(processes)
+    try:
+        parts = pool.map(_write_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+    with open(path, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+            os.remove(part)
+    return path
+
+def generate(out_dir, n_books, n_reviews, seed=0, skew=3.0, processes=1):
+    """
+    writes meta_Books.json and reviews_Books.json to out_dir.
+    :return: (books path, reviews path)
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    n_reviewers = max(1, n_reviews // 5)
+    books_path = os.path.join(out_dir, 'meta_Books.json')
+    reviews_path = os.path.join(out_dir, 'reviews_Books.json')
+    write_file(books_path, 'books', n_books, n_books, n_reviewers, skew, seed, processes)
+    write_file(reviews_path, 'reviews', n_reviews, n_books, n_reviewers, skew, seed, processes)
+    return books_path, reviews_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write a synthetic amazon books dataset')
+    parser.add_argument('--out-dir', default='synthetic')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--reviews', type=int, default=100000)
+    parser.add_argument('--skew', type=float, default=3.0,
+                        help='popularity skew, 1 is uniform, larger is steeper')
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    for path in generate(args.out_dir, args.books, args.reviews, args.seed, args.skew,
+                         args.processes):
+        print "wrote", path